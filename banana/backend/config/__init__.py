@@ -1,31 +1,101 @@
 """
 配置模块 - 提取代理、环境验证等配置逻辑
-"""
 
-from .proxy_config import setup_proxy
-from .environment import validate_environment_variables
+setup_proxy / validate_environment_variables 通过模块级 __getattr__ 按需导入，
+只读取配置常量的代码不会加载 proxy_config / environment 子模块
+"""
 
 # 直接读取并定义配置常量（避免循环导入）
 import os
+import re
+import sys
+import logging
+import importlib
+from functools import lru_cache
+
+# 配置子模块共用的日志器先挂 NullHandler，真正的处理器由入口（log_utils）统一配置
+logging.getLogger("果捷后端").addHandler(logging.NullHandler())
+
+# 一次性引用环境变量映射，避免逐个 os.getenv 调用
+_env = os.environ
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "..", "users.db")
-MANAGER_ACCOUNT = os.getenv('MANAGER_ACCOUNT', 'manager')
-MANAGER_PASSWORD = os.getenv('MANAGER_PASSWORD', None)
-MANAGER_NICKNAME = os.getenv('MANAGER_NICKNAME', '管理员')
-MANAGER_LEVEL = os.getenv('MANAGER_LEVEL', 'enterprise')
-API_HOST = os.getenv('API_HOST', '0.0.0.0')
-API_PORT = int(os.getenv('API_PORT', 8000))
-FRONTEND_ORIGINS = os.getenv('FRONTEND_ORIGINS', 'http://localhost:3000').split(',')
+MANAGER_ACCOUNT = _env.get('MANAGER_ACCOUNT', 'manager')
+MANAGER_PASSWORD = _env.get('MANAGER_PASSWORD', None)
+MANAGER_NICKNAME = _env.get('MANAGER_NICKNAME', '管理员')
+MANAGER_LEVEL = _env.get('MANAGER_LEVEL', 'enterprise')
+API_HOST = _env.get('API_HOST', '0.0.0.0')
+
+# 需要解析的配置只保存原始字符串，首次访问时再解析
+_API_PORT_RAW = _env.get('API_PORT', '8000')
+_FRONTEND_ORIGINS_RAW = _env.get('FRONTEND_ORIGINS', 'http://localhost:3000')
+
+
+@lru_cache(maxsize=1)
+def get_api_port():
+    """获取 API 端口（首次调用时解析并缓存）"""
+    return int(_API_PORT_RAW)
+
+
+_VALID_ORIGIN = re.compile(r'^https?://[^\s,]+$')
+
+
+@lru_cache(maxsize=1)
+def get_frontend_origins():
+    """
+    获取前端允许的源（首次调用时解析并缓存）
+    
+    去除空白和空项后 intern，返回不可变 tuple；格式无效的源会记录一次警告但仍保留
+    """
+    origins = []
+    for origin in _FRONTEND_ORIGINS_RAW.split(','):
+        origin = origin.strip()
+        if not origin:
+            continue
+        if not _VALID_ORIGIN.match(origin):
+            logging.getLogger("果捷后端").warning("⚠️ FRONTEND_ORIGINS 中存在格式无效的源: %s", origin)
+        origins.append(sys.intern(origin))
+    return tuple(origins)
+
+
+# 延迟解析的配置常量：模块属性访问时才计算
+_LAZY_CONSTANTS = {
+    'API_PORT': get_api_port,
+    'FRONTEND_ORIGINS': get_frontend_origins,
+}
+
+
+# 延迟导入的函数：名称 -> 所在子模块
+_LAZY_SUBMODULE_ATTRS = {
+    'setup_proxy': '.proxy_config',
+    'validate_environment_variables': '.environment',
+}
+
+
+def __getattr__(name):
+    getter = _LAZY_CONSTANTS.get(name)
+    if getter is not None:
+        return getter()
+    submodule = _LAZY_SUBMODULE_ATTRS.get(name)
+    if submodule is not None:
+        value = getattr(importlib.import_module(submodule, __name__), name)
+        # 写回模块命名空间，之后的访问不再经过 __getattr__
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = [
-    'setup_proxy', 
+    'setup_proxy',
     'validate_environment_variables',
     'DB_PATH',
     'MANAGER_ACCOUNT',
-    'MANAGER_PASSWORD', 
+    'MANAGER_PASSWORD',
     'MANAGER_NICKNAME',
     'MANAGER_LEVEL',
     'API_HOST',
     'API_PORT',
-    'FRONTEND_ORIGINS'
+    'FRONTEND_ORIGINS',
+    'get_api_port',
+    'get_frontend_origins',
 ]
@@ -1,126 +1,291 @@
 """
 环境变量验证模块 - 启动时验证关键环境变量配置
+
+仅依赖标准库（Cloud Run 元数据查询使用 http.client），不再需要 requests
 """
 import os
+import sys
+import stat
+import socket
 import logging
+import threading
+from collections import namedtuple
+from typing import Optional
 
 logger = logging.getLogger("果捷后端")
 
+# 日志输出到终端时才显示 emoji；重定向到文件/日志采集时省略
+_EMOJI_ENABLED = sys.stderr.isatty()
+
+# 验证结果缓存：首次验证后直接复用，避免重复的文件检查和元数据服务器请求
+_VALIDATION_RESULT: Optional[bool] = None
+_VALIDATION_LOCK = threading.Lock()
+
+# 是否运行在 Cloud Run（K_SERVICE 由平台注入，进程生命周期内不变）
+IS_CLOUD_RUN = bool(os.getenv('K_SERVICE'))
+
+# 元数据服务器在 GCP 内响应 <10ms，超时设短以免非 GCP 环境启动卡顿
+_METADATA_HOST = "metadata.google.internal"
+_METADATA_TIMEOUT = 0.25
+_METADATA_HEADERS = {"Metadata-Flavor": "Google"}
+_METADATA_PROJECT_ID_PATH = "/computeMetadata/v1/project/project-id"
+# 元数据服务器长连接，读取多个元数据键（项目 ID、区域等）时复用同一 TCP 连接
+_METADATA_CONN = None
+
+# 环境变量检查状态：present 表示是否已配置，display 为日志中显示的值（敏感值已脱敏）
+VarState = namedtuple('VarState', 'present display')
+
+# 主变量 -> 备用变量：主变量缺失时读取备用变量并写回主变量
+_ENV_FALLBACKS = (
+    ("VERTEX_AI_PROJECT", "GOOGLE_CLOUD_PROJECT"),
+    ("VERTEX_AI_LOCATION", "GOOGLE_CLOUD_LOCATION"),
+)
+
+# google-key.json 的固定候选路径（模块目录及上级目录），导入时计算一次
+_HERE = os.path.dirname(__file__)
+_GOOGLE_KEY_CANDIDATES = (
+    os.path.join(_HERE, 'google-key.json'),
+    os.path.join(_HERE, '..', 'google-key.json'),
+)
+# google-key.json 查找结果缓存（首次查找后其他模块可直接复用）
+_GOOGLE_KEY_PATH: Optional[str] = None
+_GOOGLE_KEY_SEARCHED = False
+
+
+def _tag(emoji: str) -> str:
+    """日志中的 emoji 前缀：仅在终端输出时保留，非 TTY（如 Cloud Logging）时省略以减少日志字节"""
+    return f"{emoji} " if _EMOJI_ENABLED else ""
+
+
+def _stat_file(path: str) -> Optional[os.stat_result]:
+    """
+    对路径执行一次 stat，是普通文件时返回 stat 结果，否则返回 None
+    
+    相比 os.path.exists + 后续读取前再次检查，只发起一次系统调用，且结果可复用（大小、修改时间）。
+    容器 overlay 文件系统上 stat 已走缓存，无需额外的 AT_STATX_DONT_SYNC 优化。
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+def _apply_env_fallbacks():
+    """
+    按 _ENV_FALLBACKS 表补齐主变量，写回 os.environ 供生成器模块读取
+    
+    Returns:
+        dict: 主变量名 -> 解析后的值（可能为 None）
+    """
+    env = os.environ
+    resolved = {}
+    for primary, fallback in _ENV_FALLBACKS:
+        value = env.get(primary)
+        if not value:
+            value = env.get(fallback)
+            if value:
+                logger.info(f"{_tag('✅')}使用 Fallback 机制: %s -> %s", fallback, primary)
+                env[primary] = value
+        resolved[primary] = value
+    return resolved
+
+
+def find_google_key(dir_names=None, force: bool = False) -> Optional[str]:
+    """
+    查找 google-key.json（当前工作目录优先，其次模块目录及上级目录）
+    
+    Args:
+        dir_names: 当前工作目录的文件名集合（已扫描时传入，避免重复 stat）
+        force: 为 True 时忽略缓存重新查找
+    
+    Returns:
+        str: 找到的文件绝对路径，未找到时返回 None
+    """
+    global _GOOGLE_KEY_PATH, _GOOGLE_KEY_SEARCHED
+    if _GOOGLE_KEY_SEARCHED and not force:
+        return _GOOGLE_KEY_PATH
+    
+    found = None
+    cwd_candidate = os.path.join(os.getcwd(), 'google-key.json')
+    if dir_names is not None:
+        if 'google-key.json' in dir_names:
+            found = cwd_candidate
+    elif _stat_file(cwd_candidate) is not None:
+        found = cwd_candidate
+    if found is None:
+        for key_path in _GOOGLE_KEY_CANDIDATES:
+            if _stat_file(key_path) is not None:
+                found = key_path
+                break
+    
+    _GOOGLE_KEY_PATH = os.path.abspath(found) if found else None
+    _GOOGLE_KEY_SEARCHED = True
+    return _GOOGLE_KEY_PATH
+
+
+def _metadata_get(path: str):
+    """
+    通过复用的 HTTP 长连接请求元数据服务器
+    
+    Returns:
+        tuple: (status_code, body_bytes)
+    """
+    global _METADATA_CONN
+    import http.client
+    if _METADATA_CONN is None:
+        _METADATA_CONN = http.client.HTTPConnection(_METADATA_HOST, timeout=_METADATA_TIMEOUT)
+    try:
+        _METADATA_CONN.request("GET", path, headers=_METADATA_HEADERS)
+        response = _METADATA_CONN.getresponse()
+        # 必须读完响应体，连接才能用于下一次请求
+        return response.status, response.read()
+    except Exception:
+        # 连接异常后丢弃，下次请求重新建立
+        _METADATA_CONN.close()
+        _METADATA_CONN = None
+        raise
+
 
-def validate_environment_variables():
-    """验证关键环境变量是否已加载，输出详细日志"""
-    logger.info("🔍 [启动验证] 检查关键环境变量配置")
+def validate_environment_variables(force: bool = False):
+    """
+    验证关键环境变量是否已加载，输出详细日志
+    
+    Args:
+        force: 为 True 时忽略缓存结果，重新执行验证
+    
+    Returns:
+        bool: 关键配置是否齐全
+    """
+    global _VALIDATION_RESULT
+    if _VALIDATION_RESULT is not None and not force:
+        return _VALIDATION_RESULT
+    with _VALIDATION_LOCK:
+        if _VALIDATION_RESULT is None or force:
+            _VALIDATION_RESULT = _run_environment_validation(force)
+        return _VALIDATION_RESULT
+
+
+def _run_environment_validation(force: bool = False):
+    """执行实际的环境变量验证"""
+    logger.info(f"{_tag('🔍')}[启动验证] 检查关键环境变量配置")
     
     # 检查工作目录和文件列表
+    # 每个环境变量只读取一次，后续统一使用局部变量（自动设置时同步更新局部变量）
+    env = os.environ
+    vertex_ai_project = env.get("VERTEX_AI_PROJECT")
+    google_cloud_project = env.get("GOOGLE_CLOUD_PROJECT")
+    google_cloud_api_key = env.get("GOOGLE_CLOUD_API_KEY")
+    google_app_credentials = env.get("GOOGLE_APPLICATION_CREDENTIALS")
+    
     current_dir = os.getcwd()
-    logger.info(f"📁 当前工作目录: {current_dir}")
+    logger.info(f"{_tag('📁')}当前工作目录: %s", current_dir)
     
-    # 列出当前目录的文件（用于调试）
-    try:
-        files_in_dir = os.listdir(current_dir)
-        logger.info(f"📋 当前目录文件列表: {', '.join(files_in_dir[:20])}...")  # 只显示前20个
-    except Exception as e:
-        logger.warning(f"⚠️ 无法列出目录文件: {e}")
+    # 仅在需要输出目录列表（DEBUG）时 scandir 一次，后续存在性检查直接在内存中完成；
+    # 生产日志级别下跳过目录遍历，只对少数候选文件做 stat
+    dir_names = None
+    if logger.isEnabledFor(logging.DEBUG):
+        try:
+            with os.scandir(current_dir) as it:
+                dir_names = {entry.name for entry in it}
+            logger.debug(f"{_tag('📋')}当前目录文件列表: %s...", ', '.join(sorted(dir_names)[:20]))  # 只显示前20个
+        except Exception as e:
+            logger.warning(f"{_tag('⚠️')}无法列出目录文件: %s", e)
+    
+    def _exists_in_cwd(name):
+        if dir_names is not None:
+            return name in dir_names
+        return _stat_file(os.path.join(current_dir, name)) is not None
     
     # 检查 .env 文件
     env_file_path = os.path.join(current_dir, '.env')
-    if os.path.exists(env_file_path):
-        logger.info(f"✅ .env 文件存在: {env_file_path}")
+    if _exists_in_cwd('.env'):
+        logger.info(f"{_tag('✅')}.env 文件存在: %s", env_file_path)
     else:
-        logger.warning(f"⚠️ .env 文件不存在: {env_file_path}")
-    
-    # 检查 google-key.json 文件
-    google_key_paths = [
-        os.path.join(current_dir, 'google-key.json'),
-        os.path.join(os.path.dirname(__file__), 'google-key.json'),
-        os.path.join(os.path.dirname(__file__), '..', 'google-key.json'),
-    ]
-    google_key_found = False
-    google_key_path = None
-    for key_path in google_key_paths:
-        if os.path.exists(key_path):
-            logger.info(f"✅ google-key.json 文件存在: {key_path}")
-            google_key_found = True
-            google_key_path = os.path.abspath(key_path)
-            # ⚠️ 重要：如果文件存在但环境变量未设置，自动设置环境变量
-            if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-                os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = google_key_path
-                logger.info(f"✅ 自动设置 GOOGLE_APPLICATION_CREDENTIALS: {google_key_path}")
-            break
-    
-    if not google_key_found:
-        logger.warning("⚠️ google-key.json 文件未找到，列出当前目录文件:")
-        try:
-            current_files = os.listdir(current_dir)
-            logger.warning(f"   当前目录文件: {', '.join(current_files)}")
-        except Exception as e:
-            logger.warning(f"   无法列出文件: {e}")
+        logger.warning(f"{_tag('⚠️')}.env 文件不存在: %s", env_file_path)
     
-    # 检查关键环境变量（使用 Fallback 机制）
-    vertex_ai_project = os.getenv("VERTEX_AI_PROJECT")
-    google_cloud_project = os.getenv("GOOGLE_CLOUD_PROJECT")
+    # 检查 google-key.json 文件（当前目录查内存集合，其余路径才 stat）
+    google_key_path = find_google_key(dir_names, force=force)
+    google_key_found = google_key_path is not None
+    if google_key_found:
+        logger.info(f"{_tag('✅')}google-key.json 文件存在: %s", google_key_path)
+        # ⚠️ 重要：如果文件存在但环境变量未设置，自动设置环境变量
+        if not google_app_credentials:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = google_key_path
+            google_app_credentials = google_key_path
+            logger.info(f"{_tag('✅')}自动设置 GOOGLE_APPLICATION_CREDENTIALS: %s", google_key_path)
+    else:
+        logger.warning(f"{_tag('⚠️')}google-key.json 文件未找到")
+        if logger.isEnabledFor(logging.DEBUG):
+            google_key_paths = (os.path.join(current_dir, 'google-key.json'),) + _GOOGLE_KEY_CANDIDATES
+            logger.debug("   已检查路径: %s", ', '.join(google_key_paths))
+            if dir_names is not None:
+                logger.debug("   当前目录文件: %s", ', '.join(sorted(dir_names)))
     
+    # 检查关键环境变量（使用 Fallback 机制）
     # ⚠️ 重要：在 Cloud Run 环境中，如果环境变量未设置，尝试从元数据服务器获取项目 ID
     if not vertex_ai_project and not google_cloud_project:
         # 检测是否在 Cloud Run 环境
-        if os.getenv('K_SERVICE'):
-            logger.info("🌐 检测到 Cloud Run 环境，尝试从元数据服务器获取项目 ID...")
+        if IS_CLOUD_RUN:
+            logger.info(f"{_tag('🌐')}检测到 Cloud Run 环境，尝试从元数据服务器获取项目 ID...")
             try:
-                import requests
+                # 先做 DNS 预检：非 GCP 环境无法解析元数据主机名，立即失败而不是等待 TCP 超时
+                socket.gethostbyname(_METADATA_HOST)
                 # 从元数据服务器获取项目 ID
-                metadata_url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
-                headers = {"Metadata-Flavor": "Google"}
-                response = requests.get(metadata_url, headers=headers, timeout=2)
-                if response.status_code == 200:
-                    project_id_from_metadata = response.text.strip()
-                    logger.info(f"✅ 从元数据服务器获取到项目 ID: {project_id_from_metadata}")
+                status_code, body = _metadata_get(_METADATA_PROJECT_ID_PATH)
+                if status_code == 200:
+                    # 项目 ID 仅含 ASCII 字符：直接在字节上 strip 后按 ASCII 严格解码（非法内容会抛异常）
+                    project_id_from_metadata = body.strip().decode('ascii')
+                    logger.info(f"{_tag('✅')}从元数据服务器获取到项目 ID: %s", project_id_from_metadata)
                     os.environ['GOOGLE_CLOUD_PROJECT'] = project_id_from_metadata
                     os.environ['VERTEX_AI_PROJECT'] = project_id_from_metadata
                     google_cloud_project = project_id_from_metadata
                     vertex_ai_project = project_id_from_metadata
                 else:
-                    logger.warning(f"⚠️ 元数据服务器返回状态码: {response.status_code}")
+                    logger.warning(f"{_tag('⚠️')}元数据服务器返回状态码: %s", status_code)
+            except socket.gaierror:
+                logger.warning(f"{_tag('⚠️')}无法解析元数据服务器地址 %s，跳过项目 ID 获取", _METADATA_HOST)
             except Exception as e:
-                logger.warning(f"⚠️ 无法从元数据服务器获取项目 ID: {str(e)}")
+                logger.warning(f"{_tag('⚠️')}无法从元数据服务器获取项目 ID: %s", e)
                 logger.warning("   这可能是正常的（如果不在 Cloud Run 环境中）")
     
-    # Fallback 机制：如果 VERTEX_AI_PROJECT 缺失，尝试读取 GOOGLE_CLOUD_PROJECT
-    if not vertex_ai_project and google_cloud_project:
-        logger.info(f"✅ 使用 Fallback 机制: GOOGLE_CLOUD_PROJECT -> VERTEX_AI_PROJECT")
-        os.environ['VERTEX_AI_PROJECT'] = google_cloud_project
-        vertex_ai_project = google_cloud_project
+    # Fallback 机制：VERTEX_AI_* 缺失时读取对应的 GOOGLE_CLOUD_*
+    resolved = _apply_env_fallbacks()
+    vertex_ai_project = resolved["VERTEX_AI_PROJECT"]
+    vertex_ai_location = resolved["VERTEX_AI_LOCATION"]
     
     # 验证关键环境变量（智能检查，不要求所有变量都设置）
-    # ⚠️ 重要：重新获取 GOOGLE_APPLICATION_CREDENTIALS（可能已被自动设置）
-    google_app_credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    if google_key_found and google_key_path and not google_app_credentials:
-        google_app_credentials = google_key_path
-    
+    # 注：google_app_credentials 在找到 google-key.json 时已同步更新
     critical_vars = {
-        "VERTEX_AI_PROJECT": vertex_ai_project or os.getenv("GOOGLE_CLOUD_PROJECT"),
-        "GOOGLE_CLOUD_PROJECT": google_cloud_project,
-        "VERTEX_AI_LOCATION": os.getenv("VERTEX_AI_LOCATION") or os.getenv("GOOGLE_CLOUD_LOCATION"),
-        "GOOGLE_CLOUD_API_KEY": "已设置" if os.getenv("GOOGLE_CLOUD_API_KEY") else "未设置",
-        "GOOGLE_APPLICATION_CREDENTIALS": google_app_credentials or ("已找到文件" if google_key_found else "未设置"),
+        "VERTEX_AI_PROJECT": VarState(bool(vertex_ai_project), vertex_ai_project),
+        "GOOGLE_CLOUD_PROJECT": VarState(bool(google_cloud_project), google_cloud_project),
+        "VERTEX_AI_LOCATION": VarState(bool(vertex_ai_location), vertex_ai_location),
+        "GOOGLE_CLOUD_API_KEY": VarState(bool(google_cloud_api_key), "***已设置***"),
+        "GOOGLE_APPLICATION_CREDENTIALS": VarState(bool(google_app_credentials) or google_key_found, "***已设置***"),
     }
     
-    logger.info("📋 环境变量状态:")
+    # 状态表拼成一条多行日志输出，避免逐行获取日志锁和序列化
+    # 有任一变量缺失时整条日志提升为 WARNING 级别
+    status_lines = [f"{_tag('📋')}环境变量状态:"]
+    status_level = logging.INFO
     # ⚠️ 智能验证：不是所有变量都必须设置
     # 1. 项目 ID 必须设置（VERTEX_AI_PROJECT 或 GOOGLE_CLOUD_PROJECT 之一）
     # 2. 认证方式必须设置（GOOGLE_CLOUD_API_KEY 或 GOOGLE_APPLICATION_CREDENTIALS 之一）
-    for var_name, var_value in critical_vars.items():
-        if var_value and var_value != "未设置":
-            logger.info(f"   ✅ {var_name}: {var_value if 'KEY' not in var_name and 'CREDENTIALS' not in var_name else '***已设置***'}")
+    for var_name, var_state in critical_vars.items():
+        if var_state.present:
+            status_lines.append(f"   {_tag('✅')}{var_name}: {var_state.display}")
         else:
             # ⚠️ 智能判断：某些变量未设置可能是正常的
             if var_name == "GOOGLE_CLOUD_PROJECT" and vertex_ai_project:
                 # 如果 VERTEX_AI_PROJECT 已设置，GOOGLE_CLOUD_PROJECT 未设置是正常的
-                logger.info(f"   ℹ️ {var_name}: 未设置（但 VERTEX_AI_PROJECT 已设置，不影响使用）")
+                status_lines.append(f"   {_tag('ℹ️')}{var_name}: 未设置（但 VERTEX_AI_PROJECT 已设置，不影响使用）")
             elif var_name == "GOOGLE_CLOUD_API_KEY" and (google_app_credentials or google_key_found):
                 # 如果使用服务账户凭据，API Key 未设置是正常的
-                logger.info(f"   ℹ️ {var_name}: 未设置（但已配置服务账户凭据，不影响使用）")
+                status_lines.append(f"   {_tag('ℹ️')}{var_name}: 未设置（但已配置服务账户凭据，不影响使用）")
             else:
-                logger.warning(f"   ⚠️ {var_name}: 未设置")
+                status_lines.append(f"   {_tag('⚠️')}{var_name}: 未设置")
+                status_level = logging.WARNING
+    logger.log(status_level, "\n".join(status_lines))
     
     # 重新评估 all_ok（更智能的判断）
     all_ok = True
@@ -128,39 +293,43 @@ def validate_environment_variables():
     # 检查项目 ID（最关键）
     project_id = vertex_ai_project or google_cloud_project
     if not project_id:
-        logger.error("=" * 80)
-        logger.error("🚨 [严重警告] VERTEX_AI_PROJECT 和 GOOGLE_CLOUD_PROJECT 均未设置！")
-        logger.error("🚨 [严重警告] 这将导致 Gemini 图片生成功能无法使用！")
-        logger.error("🚨 [严重警告] 请检查：")
-        logger.error("   1. .env 文件是否存在并包含正确的配置")
-        logger.error("   2. Cloud Run 环境变量是否通过 --set-env-vars 设置")
-        logger.error("   3. 是否在 Cloud Run 环境中（会自动注入 GOOGLE_CLOUD_PROJECT）")
-        logger.error("=" * 80)
+        logger.error("\n".join([
+            "=" * 80,
+            f"{_tag('🚨')}[严重警告] VERTEX_AI_PROJECT 和 GOOGLE_CLOUD_PROJECT 均未设置！",
+            f"{_tag('🚨')}[严重警告] 这将导致 Gemini 图片生成功能无法使用！",
+            f"{_tag('🚨')}[严重警告] 请检查：",
+            "   1. .env 文件是否存在并包含正确的配置",
+            "   2. Cloud Run 环境变量是否通过 --set-env-vars 设置",
+            "   3. 是否在 Cloud Run 环境中（会自动注入 GOOGLE_CLOUD_PROJECT）",
+            "=" * 80,
+        ]))
         all_ok = False
     else:
-        logger.info(f"✅ 项目 ID: {project_id}")
+        logger.info(f"{_tag('✅')}项目 ID: %s", project_id)
     
-    # 检查认证方式（重新获取，可能已被自动设置）
-    has_api_key = bool(os.getenv("GOOGLE_CLOUD_API_KEY"))
-    has_credentials = bool(os.getenv("GOOGLE_APPLICATION_CREDENTIALS")) or google_key_found
+    # 检查认证方式
+    has_api_key = bool(google_cloud_api_key)
+    has_credentials = bool(google_app_credentials) or google_key_found
     
     if not has_api_key and not has_credentials:
-        logger.error("=" * 80)
-        logger.error("🚨 [严重警告] 未设置任何认证方式！")
-        logger.error("🚨 [严重警告] 请设置 GOOGLE_CLOUD_API_KEY 或 GOOGLE_APPLICATION_CREDENTIALS")
-        logger.error("🚨 [严重警告] 或者确保 google-key.json 文件存在于容器中")
-        logger.error("=" * 80)
+        logger.error("\n".join([
+            "=" * 80,
+            f"{_tag('🚨')}[严重警告] 未设置任何认证方式！",
+            f"{_tag('🚨')}[严重警告] 请设置 GOOGLE_CLOUD_API_KEY 或 GOOGLE_APPLICATION_CREDENTIALS",
+            f"{_tag('🚨')}[严重警告] 或者确保 google-key.json 文件存在于容器中",
+            "=" * 80,
+        ]))
         all_ok = False
     else:
         if has_credentials:
-            creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or (google_key_path if google_key_found else "未指定")
-            logger.info(f"✅ 认证方式: 服务账户凭据 ({creds_path})")
+            creds_path = google_app_credentials or (google_key_path if google_key_found else "未指定")
+            logger.info(f"{_tag('✅')}认证方式: 服务账户凭据 (%s)", creds_path)
         if has_api_key:
-            logger.info(f"✅ 认证方式: API Key")
+            logger.info(f"{_tag('✅')}认证方式: API Key")
     
     if all_ok:
-        logger.info("✅ [启动验证] 环境变量配置检查通过")
+        logger.info(f"{_tag('✅')}[启动验证] 环境变量配置检查通过")
     else:
-        logger.error("❌ [启动验证] 环境变量配置检查失败，请查看上述警告")
+        logger.error(f"{_tag('❌')}[启动验证] 环境变量配置检查失败，请查看上述警告")
     
     return all_ok
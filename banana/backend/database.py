@@ -5,10 +5,17 @@
 
 import sqlite3
 import os
+import asyncio
+import hmac
+import time
+import secrets
 import logging
-from typing import Optional, List, Dict
+import threading
+from typing import Optional, List, Dict, Iterator, Union, Tuple
+from collections import OrderedDict
 from datetime import datetime
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # 在文件顶部导入 config，避免循环导入问题
 from config import MANAGER_ACCOUNT, MANAGER_PASSWORD, MANAGER_NICKNAME, MANAGER_LEVEL
@@ -22,27 +29,134 @@ try:
 except ImportError:
     BCRYPT_AVAILABLE = False
     import hashlib
-    import secrets
     logger.warning("⚠️  bcrypt 未安装，使用 hashlib 作为备用（安全性较低）")
     logger.warning("   建议安装: pip install bcrypt")
 
+# bcrypt 成本因子（2^rounds 轮），可通过环境变量按部署机器性能调整
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+
+# 密码校验线程池（bcrypt 为 CPU 密集型且会释放 GIL，按 CPU 核数并行）
+_password_pool: Optional[ThreadPoolExecutor] = None
+_password_pool_lock = threading.Lock()
+
 # 数据库文件路径
 DB_PATH = os.path.join(os.path.dirname(__file__), "users.db")
 
 
+# 当前时间 ISO 字符串缓存：(毫秒时间戳, ISO 字符串)，同一毫秒内直接复用
+_now_iso_cache = (0, '')
+
+
+def _now_iso() -> str:
+    """返回当前本地时间的 ISO 格式字符串（按毫秒缓存，避免频繁构造 datetime）"""
+    global _now_iso_cache
+    now_ms = time.time_ns() // 1_000_000
+    cached_ms, cached_iso = _now_iso_cache
+    if now_ms == cached_ms:
+        return cached_iso
+    now_iso = datetime.fromtimestamp(now_ms / 1000).isoformat()
+    _now_iso_cache = (now_ms, now_iso)
+    return now_iso
+
+
 def get_db_path():
     """获取数据库文件路径"""
     return DB_PATH
 
 
+# 认证热路径 SQL：统一使用同一字符串对象，命中 sqlite3 连接级语句缓存
+_SQL_GET_USER_BY_ID = "SELECT * FROM users WHERE id = ?"
+_SQL_GET_USER_BY_ACCOUNT = "SELECT * FROM users WHERE account = ?"
+_SQL_GET_SESSION = """
+                SELECT u.id, u.account, u.nickname, u.avatar, u.level, u.created_at, u.updated_at,
+                       s.expires_at AS session_expires_at
+                FROM sessions s JOIN users u ON u.id = s.user_id
+                WHERE s.session_token = ? AND s.expires_at > ?
+            """
+_SQL_INSERT_SESSION = """
+                INSERT INTO sessions (session_token, user_id, created_at, expires_at)
+                VALUES (?, ?, ?, ?)
+            """
+_SQL_DELETE_SESSION = "DELETE FROM sessions WHERE session_token = ?"
+
+# 会话查询结果缓存：session_token -> (过期时间戳秒, 用户信息)，按 LRU 淘汰
+# 会话仅在登录/登出/清理时变化，命中后无需访问 SQLite
+_SESSION_CACHE_MAX = 4096
+_SESSION_CACHE: "OrderedDict[str, Tuple[int, Dict]]" = OrderedDict()
+_SESSION_CACHE_LOCK = threading.Lock()
+
+# 建立连接后预编译的只读查询（写语句不预执行，避免产生副作用）
+_PREWARM_QUERIES = (
+    (_SQL_GET_USER_BY_ID, 1),
+    (_SQL_GET_USER_BY_ACCOUNT, 1),
+    (_SQL_GET_SESSION, 2),
+)
+
+# 每个连接建立时应用的 PRAGMA（WAL 模式下 synchronous=NORMAL 已足够安全）
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256MB
+    "PRAGMA cache_size=-65536",     # 64MB
+    # 注：不开启 foreign_keys —— 内置管理员会话/反馈使用虚拟 user_id 'manager_user'，不在 users 表中
+)
+
+# 每个线程缓存一个长连接，避免每次查询都重新打开数据库（读取文件头、解析 schema、重建语句缓存）
+_tls = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+# close_db() 后递增，使各线程缓存的旧连接失效并在下次使用时重建
+_connection_generation = 0
+
+
+def _get_thread_connection() -> sqlite3.Connection:
+    """获取当前线程的数据库长连接（首次调用时创建）"""
+    conn = getattr(_tls, 'conn', None)
+    if conn is None or getattr(_tls, 'generation', None) != _connection_generation:
+        # check_same_thread=False 仅用于 close_db() 在关闭阶段统一关闭各线程的连接
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row  # 使用 Row 工厂，可以通过列名访问
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _prewarm_statements(conn)
+        _tls.conn = conn
+        _tls.generation = _connection_generation
+        with _all_connections_lock:
+            _all_connections.append(conn)
+    return conn
+
+
+def _prewarm_statements(conn: sqlite3.Connection):
+    """预编译热路径只读查询，填充该连接的语句缓存"""
+    for sql, param_count in _PREWARM_QUERIES:
+        try:
+            conn.execute(sql, (None,) * param_count).fetchall()
+        except sqlite3.OperationalError:
+            # 表尚未创建（init_database 之前）时跳过
+            return
+
+
+def close_db():
+    """关闭所有线程缓存的数据库连接（应用关闭时调用）"""
+    global _connection_generation
+    with _all_connections_lock:
+        connections = list(_all_connections)
+        _all_connections.clear()
+        _connection_generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ 关闭数据库连接失败: {e}")
+
+
 @contextmanager
 def get_db_connection():
     """
     获取数据库连接的上下文管理器
-    自动处理连接的开启和关闭
+    复用当前线程的长连接，退出时提交事务（异常时回滚），不关闭连接
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # 使用 Row 工厂，可以通过列名访问
+    conn = _get_thread_connection()
     try:
         yield conn
         conn.commit()
@@ -50,8 +164,147 @@ def get_db_connection():
         conn.rollback()
         logger.error(f"数据库操作失败: {e}")
         raise
-    finally:
-        conn.close()
+
+
+# sessions 表结构（建表与旧表迁移共用）
+_SESSIONS_TABLE_SQL = """
+-- 创建 sessions 表（会话存储表 - 替代内存存储）
+-- created_at / expires_at 为 Unix 时间戳（秒），过期判断与索引均为整数比较
+CREATE TABLE IF NOT EXISTS sessions (
+    session_token TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+-- 创建会话索引
+CREATE INDEX IF NOT EXISTS idx_session_user_id ON sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_session_expires_at ON sessions(expires_at);
+"""
+
+# 数据库表结构（executescript 一次执行）
+_SCHEMA_SQL = """
+BEGIN;
+
+-- 创建 users 表
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    account TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    nickname TEXT,
+    avatar TEXT,
+    level TEXT DEFAULT 'normal',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+-- 创建索引
+CREATE INDEX IF NOT EXISTS idx_account ON users(account);
+CREATE INDEX IF NOT EXISTS idx_created_at ON users(created_at);
+
+-- 创建 feedbacks 表（反馈意见表）
+CREATE TABLE IF NOT EXISTS feedbacks (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    account TEXT NOT NULL,
+    feedback TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    reply TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    replied_at TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+-- 创建反馈表索引
+-- (user_id, created_at DESC) 复合索引：按用户查询并按时间倒序时无需额外排序，
+-- 同时覆盖只按 user_id 的查询，因此移除旧的单列索引
+CREATE INDEX IF NOT EXISTS idx_feedback_user_created ON feedbacks(user_id, created_at DESC);
+DROP INDEX IF EXISTS idx_feedback_user_id;
+CREATE INDEX IF NOT EXISTS idx_feedback_account ON feedbacks(account);
+CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedbacks(created_at);
+
+""" + _SESSIONS_TABLE_SQL + """
+-- 创建 chat_messages 表（聊天历史，按 用户ID + 聊天会话ID 保存每一轮消息）
+-- session_id 由客户端提供，只在同一用户内区分会话，读写都必须带上 user_id
+-- ts 为毫秒时间戳；同一毫秒内写入的多条消息按 rowid 保持顺序
+CREATE TABLE IF NOT EXISTS chat_messages (
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_messages_owner_ts ON chat_messages(user_id, session_id, ts DESC);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_ts ON chat_messages(ts);
+
+COMMIT;
+"""
+
+
+def _to_epoch_seconds(value: Union[int, float, str]) -> int:
+    """将 ISO 时间字符串或时间戳统一转换为整数 Unix 时间戳（秒）"""
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    return int(value)
+
+
+def _to_epoch_seconds_or_none(value) -> Optional[int]:
+    """迁移用：无法解析的旧时间返回 NULL（对应的旧会话被丢弃，用户重新登录即可）"""
+    try:
+        return _to_epoch_seconds(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _migrate_sessions_to_epoch(conn: sqlite3.Connection):
+    """
+    将旧版 sessions 表（created_at / expires_at 为 TEXT ISO 字符串）迁移为 INTEGER 时间戳
+    
+    ISO 字符串按本地时间解析，与旧版 datetime.now().isoformat() 的写入方式一致。
+    改名、建新表、复制数据、删除旧表在同一个事务中完成，任一步失败整体回滚，
+    旧表保持原样，下次启动重新迁移
+    """
+    columns = {row['name']: row['type'] for row in conn.execute("PRAGMA table_info(sessions)")}
+    if columns.get('expires_at', '').upper() != 'TEXT':
+        return
+    
+    total = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    # 时间转换注册为 SQL 函数，数据复制与表结构变更在同一条脚本、同一个事务中执行
+    conn.create_function("to_epoch_seconds", 1, _to_epoch_seconds_or_none, deterministic=True)
+    conn.executescript("""
+        BEGIN;
+        DROP INDEX IF EXISTS idx_session_user_id;
+        DROP INDEX IF EXISTS idx_session_expires_at;
+        ALTER TABLE sessions RENAME TO sessions_legacy;
+    """ + _SESSIONS_TABLE_SQL + """
+        INSERT INTO sessions (session_token, user_id, created_at, expires_at)
+        SELECT session_token, user_id, created_at, expires_at FROM (
+            SELECT session_token, user_id,
+                   to_epoch_seconds(created_at) AS created_at,
+                   to_epoch_seconds(expires_at) AS expires_at
+            FROM sessions_legacy
+        )
+        WHERE created_at IS NOT NULL AND expires_at IS NOT NULL;
+        DROP TABLE sessions_legacy;
+        COMMIT;
+    """)
+    migrated = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    logger.info(f"✅ sessions 表已迁移为整数时间戳: {migrated}/{total} 条会话保留")
+
+
+def _drop_unowned_chat_messages(conn: sqlite3.Connection):
+    """
+    删除旧版没有 user_id 列的 chat_messages 表（在建表脚本之前执行）
+    
+    旧表只按客户端提供的 session_id 区分，无法确定消息归属，不能安全地迁移给任何用户
+    """
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(chat_messages)")}
+    if columns and 'user_id' not in columns:
+        conn.executescript("DROP TABLE chat_messages;")
+        logger.warning("⚠️ 已删除旧版 chat_messages 表（消息没有归属用户）")
 
 
 def init_database():
@@ -60,82 +313,19 @@ def init_database():
     """
     try:
         with get_db_connection() as conn:
-            cursor = conn.cursor()
+            # WAL 模式持久化在数据库文件中：写入不再阻塞并发读取，且提交无需每次 fsync
+            conn.execute("PRAGMA journal_mode=WAL")
             
-            # 创建 users 表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    account TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    nickname TEXT,
-                    avatar TEXT,
-                    level TEXT DEFAULT 'normal',
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL
-                )
-            """)
-            
-            # 创建索引
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_account ON users(account)
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_created_at ON users(created_at)
-            """)
-            
-            # 创建 feedbacks 表（反馈意见表）
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS feedbacks (
-                    id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    account TEXT NOT NULL,
-                    feedback TEXT NOT NULL,
-                    contact TEXT NOT NULL,
-                    reply TEXT,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL,
-                    replied_at TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            """)
-            
-            # 创建反馈表索引
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_user_id ON feedbacks(user_id)
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_account ON feedbacks(account)
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedbacks(created_at)
-            """)
-            
-            # 创建 sessions 表（会话存储表 - 替代内存存储）
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS sessions (
-                    session_token TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    expires_at TEXT NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            """)
-            
-            # 创建会话索引
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_session_user_id ON sessions(user_id)
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_session_expires_at ON sessions(expires_at)
-            """)
+            # 整个 schema 一次性提交，表和索引在同一个写事务中创建
+            _drop_unowned_chat_messages(conn)
+            conn.executescript(_SCHEMA_SQL)
+            _migrate_sessions_to_epoch(conn)
             
             logger.info("✅ 数据库表初始化完成")
             
+            # 表结构就绪后预编译热路径查询
+            _prewarm_statements(conn)
+            
             # 设置数据库文件权限（仅所有者可读写）
             try:
                 os.chmod(DB_PATH, 0o600)
@@ -148,6 +338,18 @@ def init_database():
         raise
 
 
+def _sha256_hash(password: str, salt: str):
+    """
+    计算 SHA256 备用方案的哈希对象：sha256(password + salt)
+    
+    分两次 update 分别喂入已编码的字节，避免拼接字符串再整体编码；
+    结果与原有 sha256:salt:hash 格式完全兼容
+    """
+    hash_obj = hashlib.sha256(password.encode('utf-8'))
+    hash_obj.update(salt.encode('ascii'))
+    return hash_obj
+
+
 def hash_password(password: str) -> str:
     """
     加密密码（优先使用 bcrypt，否则使用 SHA256）
@@ -159,18 +361,25 @@ def hash_password(password: str) -> str:
         加密后的密码哈希值
     """
     if BCRYPT_AVAILABLE:
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
         hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
         return hashed.decode('utf-8')
     else:
         # 备用方案：使用 SHA256（安全性较低，仅用于开发测试）
         salt = secrets.token_hex(16)
-        hash_obj = hashlib.sha256()
-        hash_obj.update((password + salt).encode('utf-8'))
-        hashed = hash_obj.hexdigest()
+        hashed = _sha256_hash(password, salt).hexdigest()
         return f"sha256:{salt}:{hashed}"  # 格式：sha256:salt:hash
 
 
+def _hash_type(password_hash: str) -> str:
+    """返回密码哈希类型（仅用于日志）"""
+    if password_hash.startswith('$'):
+        return 'bcrypt'
+    if password_hash.startswith('sha256:'):
+        return 'sha256'
+    return '未知'
+
+
 def verify_password(password: str, password_hash: str) -> bool:
     """
     验证密码是否匹配
@@ -183,56 +392,70 @@ def verify_password(password: str, password_hash: str) -> bool:
         是否匹配
     """
     try:
-        logger.info(f"🔐 [verify_password] 开始验证密码")
-        logger.info(f"   密码长度: {len(password)} 字符")
-        logger.info(f"   密码哈希类型: {'bcrypt' if password_hash.startswith('$') else 'sha256' if password_hash.startswith('sha256:') else '未知'}")
-        logger.info(f"   密码哈希预览: {password_hash[:50]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔐 [verify_password] 开始验证密码: 长度=%d, 哈希类型=%s, 哈希预览=%.50s...",
+                         len(password), _hash_type(password_hash), password_hash)
         
         if BCRYPT_AVAILABLE:
-            logger.info(f"   使用 bcrypt 验证")
             result = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
-            logger.info(f"   bcrypt 验证结果: {'✅ 匹配' if result else '❌ 不匹配'}")
+            logger.debug("   bcrypt 验证结果: %s", result)
             return result
         else:
             # 备用方案：SHA256 验证
-            logger.info(f"   使用 SHA256 验证（bcrypt 未安装）")
             if not password_hash.startswith('sha256:'):
-                logger.error(f"   ❌ 密码哈希格式错误: 不是 sha256 格式")
+                logger.error("   ❌ 密码哈希格式错误: 不是 sha256 格式")
                 return False
             
             try:
                 _, salt, stored_hash = password_hash.split(':', 2)
-                logger.info(f"   提取 salt: {salt[:10]}...")
-                logger.info(f"   存储的哈希: {stored_hash[:20]}...")
-                
-                hash_obj = hashlib.sha256()
-                hash_obj.update((password + salt).encode('utf-8'))
-                computed_hash = hash_obj.hexdigest()
-                logger.info(f"   计算的哈希: {computed_hash[:20]}...")
                 
-                result = computed_hash == stored_hash
-                logger.info(f"   SHA256 验证结果: {'✅ 匹配' if result else '❌ 不匹配'}")
-                if not result:
-                    logger.warning(f"   哈希不匹配！")
-                    logger.warning(f"   存储的: {stored_hash[:40]}...")
-                    logger.warning(f"   计算的: {computed_hash[:40]}...")
+                hash_obj = _sha256_hash(password, salt)
                 
+                # 常量时间比较原始摘要字节，避免时序侧信道（格式非法的十六进制会抛 ValueError）
+                result = hmac.compare_digest(bytes.fromhex(stored_hash), hash_obj.digest())
+                logger.debug("   SHA256 验证结果: %s", result)
                 return result
             except ValueError as e:
-                logger.error(f"   ❌ 解析密码哈希失败: {e}")
-                logger.error(f"   密码哈希格式: {password_hash[:100]}")
+                logger.error("   ❌ 解析密码哈希失败: %s", e)
                 return False
-    except Exception as e:
-        logger.error(f"❌ [verify_password] 密码验证异常: {e}")
-        logger.error(f"   异常类型: {type(e).__name__}")
-        import traceback
-        logger.error(f"   异常堆栈: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("❌ [verify_password] 密码验证异常")
         return False
 
 
+def _get_password_pool() -> ThreadPoolExecutor:
+    """获取密码校验线程池（首次使用时创建）"""
+    global _password_pool
+    if _password_pool is None:
+        with _password_pool_lock:
+            if _password_pool is None:
+                _password_pool = ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    thread_name_prefix="password-verify"
+                )
+    return _password_pool
+
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    """在线程池中验证密码，避免 bcrypt 计算阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_pool(), verify_password, password, password_hash)
+
+
 def generate_user_id() -> str:
     """生成用户ID"""
-    return f"user_{int(datetime.now().timestamp() * 1000)}_{os.urandom(4).hex()}"
+    return f"user_{time.time_ns() // 1_000_000}_{secrets.token_hex(4)}"
+
+
+def generate_user_ids(n: int) -> List[str]:
+    """
+    批量生成用户ID（批量导入/测试数据使用）
+    
+    只取一次时间戳和一次随机字节，时间戳部分按序号递增以保证批内唯一
+    """
+    ts = time.time_ns() // 1_000_000
+    rnd = secrets.token_bytes(4 * n)
+    return [f"user_{ts + i}_{rnd[i * 4:(i + 1) * 4].hex()}" for i in range(n)]
 
 
 def create_user(
@@ -256,11 +479,6 @@ def create_user(
         用户信息字典（不包含密码）
     """
     try:
-        # 检查账号是否已存在
-        existing_user = get_user_by_account(account)
-        if existing_user:
-            raise ValueError(f"账号 {account} 已被注册")
-        
         # 生成用户ID
         user_id = generate_user_id()
         
@@ -272,17 +490,23 @@ def create_user(
             nickname = account.split('@')[0] if '@' in account else account[:3] + '***'
         
         # 创建时间
-        now = datetime.now().isoformat()
+        now = _now_iso()
         
-        # 插入数据库
+        # 插入数据库：账号唯一性由 ON CONFLICT 原子判断，已存在时不插入也无返回行
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO users (id, account, password_hash, nickname, avatar, level, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(account) DO NOTHING
+                RETURNING id
             """, (user_id, account, password_hash, nickname, avatar, level, now, now))
-            
-            logger.info(f"✅ 用户创建成功: {account} (ID: {user_id})")
+            inserted = cursor.fetchone()
+        
+        if not inserted:
+            raise ValueError(f"账号 {account} 已被注册")
+        
+        logger.info(f"✅ 用户创建成功: {account} (ID: {user_id})")
         
         # 返回用户信息（不包含密码）
         return {
@@ -313,7 +537,7 @@ def get_user_by_id(user_id: str) -> Optional[Dict]:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            cursor.execute(_SQL_GET_USER_BY_ID, (user_id,))
             row = cursor.fetchone()
             
             if row:
@@ -328,8 +552,8 @@ def get_user_by_id(user_id: str) -> Optional[Dict]:
                 }
             return None
             
-    except Exception as e:
-        logger.error(f"获取用户失败: {e}")
+    except Exception:
+        logger.exception("获取用户失败")
         return None
 
 
@@ -346,7 +570,7 @@ def get_user_by_account(account: str) -> Optional[Dict]:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE account = ?", (account,))
+            cursor.execute(_SQL_GET_USER_BY_ACCOUNT, (account,))
             row = cursor.fetchone()
             
             if row:
@@ -362,8 +586,8 @@ def get_user_by_account(account: str) -> Optional[Dict]:
                 }
             return None
             
-    except Exception as e:
-        logger.error(f"获取用户失败: {e}")
+    except Exception:
+        logger.exception("获取用户失败")
         return None
 
 
@@ -379,26 +603,16 @@ def verify_user_login(account: str, password: str) -> Optional[Dict]:
         用户信息字典（不包含密码），如果验证失败返回 None
     """
     try:
-        logger.info(f"🔍 [verify_user_login] 开始验证: 账号={account}, 密码长度={len(password)}")
+        logger.debug("🔍 [verify_user_login] 开始验证: 账号=%s", account)
         
         user = get_user_by_account(account)
         if not user:
-            logger.warning(f"❌ [verify_user_login] 登录失败: 账号 {account} 不存在")
+            logger.warning("❌ [verify_user_login] 登录失败: 账号 %s 不存在", account)
             return None
         
-        logger.info(f"✅ [verify_user_login] 找到用户: ID={user['id']}, 账号={user['account']}")
-        logger.info(f"   密码哈希类型: {'bcrypt' if user['password_hash'].startswith('$') else 'sha256' if user['password_hash'].startswith('sha256:') else '未知'}")
-        logger.info(f"   密码哈希预览: {user['password_hash'][:50]}...")
-        
-        # 验证密码
-        logger.info(f"🔐 [verify_user_login] 开始验证密码...")
-        password_match = verify_password(password, user['password_hash'])
-        logger.info(f"   密码验证结果: {'✅ 匹配' if password_match else '❌ 不匹配'}")
-        
-        if not password_match:
-            logger.warning(f"❌ [verify_user_login] 登录失败: 账号 {account} 密码错误")
-            logger.warning(f"   输入的密码长度: {len(password)}")
-            logger.warning(f"   密码哈希类型: {'bcrypt' if user['password_hash'].startswith('$') else 'sha256' if user['password_hash'].startswith('sha256:') else '未知'}")
+        # 验证密码（哈希类型等细节由 verify_password 在 DEBUG 级别输出）
+        if not verify_password(password, user['password_hash']):
+            logger.warning("❌ [verify_user_login] 登录失败: 账号 %s 密码错误", account)
             return None
         
         # 返回用户信息（不包含密码）
@@ -412,14 +626,20 @@ def verify_user_login(account: str, password: str) -> Optional[Dict]:
             'updatedAt': user['updatedAt']
         }
         
-        logger.info(f"✅ 用户登录成功: {account}")
+        logger.info("✅ 用户登录成功: %s", account)
         return user_without_password
         
-    except Exception as e:
-        logger.error(f"验证登录失败: {e}")
+    except Exception:
+        logger.exception("验证登录失败")
         return None
 
 
+async def verify_user_login_async(account: str, password: str) -> Optional[Dict]:
+    """verify_user_login 的异步版本：在线程池中执行，供 async 路由调用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_pool(), verify_user_login, account, password)
+
+
 def update_user(user_id: str, updates: Dict) -> Optional[Dict]:
     """
     更新用户信息
@@ -432,11 +652,6 @@ def update_user(user_id: str, updates: Dict) -> Optional[Dict]:
         更新后的用户信息字典（不包含密码），如果失败返回 None
     """
     try:
-        # 检查用户是否存在
-        user = get_user_by_id(user_id)
-        if not user:
-            raise ValueError(f"用户 {user_id} 不存在")
-        
         # 构建更新语句
         allowed_fields = ['nickname', 'avatar', 'level', 'password_hash']
         set_clauses = []
@@ -448,26 +663,46 @@ def update_user(user_id: str, updates: Dict) -> Optional[Dict]:
                 values.append(updates[field])
         
         if not set_clauses:
-            return user  # 没有要更新的字段
+            # 没有要更新的字段，直接返回当前用户信息
+            user = get_user_by_id(user_id)
+            if not user:
+                raise ValueError(f"用户 {user_id} 不存在")
+            return user
         
         # 添加更新时间
         set_clauses.append("updated_at = ?")
-        values.append(datetime.now().isoformat())
+        values.append(_now_iso())
         values.append(user_id)  # WHERE 条件的值
         
-        # 执行更新
+        # 执行更新并通过 RETURNING 直接取回更新后的行（用户不存在时无返回行）
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            sql = f"UPDATE users SET {', '.join(set_clauses)} WHERE id = ?"
+            sql = (
+                f"UPDATE users SET {', '.join(set_clauses)} WHERE id = ? "
+                "RETURNING id, account, nickname, avatar, level, created_at, updated_at"
+            )
             cursor.execute(sql, values)
-            
-            logger.info(f"✅ 用户信息更新成功: {user_id}")
+            row = cursor.fetchone()
+        
+        if not row:
+            raise ValueError(f"用户 {user_id} 不存在")
+        
+        _invalidate_cached_sessions(user_id)
+        logger.info(f"✅ 用户信息更新成功: {user_id}")
         
         # 返回更新后的用户信息
-        return get_user_by_id(user_id)
+        return {
+            'id': row['id'],
+            'account': row['account'],
+            'nickname': row['nickname'],
+            'avatar': row['avatar'],
+            'level': row['level'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at']
+        }
         
-    except Exception as e:
-        logger.error(f"更新用户失败: {e}")
+    except Exception:
+        logger.exception("更新用户失败")
         return None
 
 
@@ -486,24 +721,23 @@ def get_all_users() -> List[Dict]:
                 FROM users
                 ORDER BY created_at DESC
             """)
-            rows = cursor.fetchall()
             
-            users = []
-            for row in rows:
-                users.append({
-                    'id': row['id'],
-                    'account': row['account'],
-                    'nickname': row['nickname'],
-                    'avatar': row['avatar'],
-                    'level': row['level'],
-                    'createdAt': row['created_at'],
-                    'updatedAt': row['updated_at']
-                })
-            
-            return users
+            # 按位置解包列，避免每行逐列按名称查找
+            return [
+                {
+                    'id': uid,
+                    'account': account,
+                    'nickname': nickname,
+                    'avatar': avatar,
+                    'level': level,
+                    'createdAt': created_at,
+                    'updatedAt': updated_at
+                }
+                for uid, account, nickname, avatar, level, created_at, updated_at in cursor
+            ]
             
-    except Exception as e:
-        logger.error(f"获取用户列表失败: {e}")
+    except Exception:
+        logger.exception("获取用户列表失败")
         return []
 
 
@@ -537,13 +771,13 @@ def create_manager_account(account: str = None, password: str = None, nickname:
                 "或在创建时传递 password 参数"
             )
         
-        # 检查账号是否已存在
+        # 检查账号是否已存在（每次启动都会调用，先查询可避免无谓的密码哈希计算）
         existing = get_user_by_account(account)
         if existing:
             logger.info(f"ℹ️  管理员账号 '{account}' 已存在，跳过创建")
             return existing
         
-        # 创建管理员账号
+        # 创建管理员账号（并发创建时由 create_user 的 ON CONFLICT 保证唯一）
         manager = create_user(
             account=account,
             password=password,
@@ -568,7 +802,7 @@ def create_manager_account(account: str = None, password: str = None, nickname:
 
 def generate_feedback_id() -> str:
     """生成反馈ID"""
-    return f"feedback_{int(datetime.now().timestamp() * 1000)}_{os.urandom(4).hex()}"
+    return f"feedback_{time.time_ns() // 1_000_000}_{secrets.token_hex(4)}"
 
 
 def create_feedback(
@@ -591,7 +825,7 @@ def create_feedback(
     """
     try:
         feedback_id = generate_feedback_id()
-        now = datetime.now().isoformat()
+        now = _now_iso()
         
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -619,6 +853,11 @@ def create_feedback(
         raise
 
 
+# 反馈查询的列顺序与返回字典的键（按位置构造字典，避免逐列按名称查找）
+_FEEDBACK_COLUMNS = "id, user_id, account, feedback, contact, reply, created_at, updated_at, replied_at"
+_FEEDBACK_KEYS = ('id', 'user_id', 'account', 'feedback', 'contact', 'reply', 'createdAt', 'updatedAt', 'repliedAt')
+
+
 def get_feedbacks_by_user_id(user_id: str) -> List[Dict]:
     """
     获取指定用户的所有反馈记录
@@ -632,34 +871,68 @@ def get_feedbacks_by_user_id(user_id: str) -> List[Dict]:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM feedbacks
+            cursor.execute(f"""
+                SELECT {_FEEDBACK_COLUMNS} FROM feedbacks
                 WHERE user_id = ?
                 ORDER BY created_at DESC
             """, (user_id,))
-            rows = cursor.fetchall()
-            
-            feedbacks = []
-            for row in rows:
-                feedbacks.append({
-                    'id': row['id'],
-                    'user_id': row['user_id'],
-                    'account': row['account'],
-                    'feedback': row['feedback'],
-                    'contact': row['contact'],
-                    'reply': row['reply'],
-                    'createdAt': row['created_at'],
-                    'updatedAt': row['updated_at'],
-                    'repliedAt': row['replied_at']
-                })
+            keys = _FEEDBACK_KEYS
+            return [dict(zip(keys, row)) for row in cursor]
             
-            return feedbacks
-            
-    except Exception as e:
-        logger.error(f"获取用户反馈失败: {e}")
+    except Exception:
+        logger.exception("获取用户反馈失败")
         return []
 
 
+# 全部反馈按批读取的每批条数；created_at 相同时按 id 排序，保证分页顺序稳定
+_FEEDBACK_PAGE_SIZE = 500
+_SQL_FEEDBACK_FIRST_PAGE = f"""
+            SELECT {_FEEDBACK_COLUMNS} FROM feedbacks
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?
+        """
+_SQL_FEEDBACK_NEXT_PAGE = f"""
+            SELECT {_FEEDBACK_COLUMNS} FROM feedbacks
+            WHERE (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        """
+
+
+def iter_all_feedbacks(limit: Optional[int] = None, offset: int = 0) -> Iterator[Dict]:
+    """
+    逐批产出反馈记录（按创建时间倒序），不在内存中构建完整列表
+    
+    每批最多 _FEEDBACK_PAGE_SIZE 条，在各自的短查询中读完后才产出，产出时已退出 get_db_connection；
+    调用方提前停止迭代，或在循环中执行其他数据库操作，都不会在线程共享连接上遗留未结束的事务。
+    第一批之后按上一批最后一条的 (created_at, id) 继续读取，迭代期间新增的反馈不会导致重复
+    
+    Args:
+        limit: 最多返回的条数（None 表示不限制）
+        offset: 跳过的条数
+        
+    Yields:
+        反馈信息字典
+    """
+    keys = _FEEDBACK_KEYS
+    remaining = limit
+    last = None
+    while remaining is None or remaining > 0:
+        page_size = _FEEDBACK_PAGE_SIZE if remaining is None else min(remaining, _FEEDBACK_PAGE_SIZE)
+        with get_db_connection() as conn:
+            if last is None:
+                rows = conn.execute(_SQL_FEEDBACK_FIRST_PAGE, (page_size, offset)).fetchall()
+            else:
+                rows = conn.execute(_SQL_FEEDBACK_NEXT_PAGE, (*last, page_size)).fetchall()
+        for row in rows:
+            yield dict(zip(keys, row))
+        if len(rows) < page_size:
+            return
+        last = (rows[-1]['created_at'], rows[-1]['id'])
+        if remaining is not None:
+            remaining -= len(rows)
+
+
 def get_all_feedbacks() -> List[Dict]:
     """
     获取所有反馈记录（管理员功能）
@@ -668,32 +941,9 @@ def get_all_feedbacks() -> List[Dict]:
         反馈记录列表
     """
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM feedbacks
-                ORDER BY created_at DESC
-            """)
-            rows = cursor.fetchall()
-            
-            feedbacks = []
-            for row in rows:
-                feedbacks.append({
-                    'id': row['id'],
-                    'user_id': row['user_id'],
-                    'account': row['account'],
-                    'feedback': row['feedback'],
-                    'contact': row['contact'],
-                    'reply': row['reply'],
-                    'createdAt': row['created_at'],
-                    'updatedAt': row['updated_at'],
-                    'repliedAt': row['replied_at']
-                })
-            
-            return feedbacks
-            
-    except Exception as e:
-        logger.error(f"获取所有反馈失败: {e}")
+        return list(iter_all_feedbacks())
+    except Exception:
+        logger.exception("获取所有反馈失败")
         return []
 
 
@@ -727,8 +977,8 @@ def get_feedback_by_id(feedback_id: str) -> Optional[Dict]:
                 }
             return None
             
-    except Exception as e:
-        logger.error(f"获取反馈失败: {e}")
+    except Exception:
+        logger.exception("获取反馈失败")
         return None
 
 
@@ -744,26 +994,38 @@ def update_feedback_reply(feedback_id: str, reply: str) -> Optional[Dict]:
         更新后的反馈信息字典，如果失败返回 None
     """
     try:
-        feedback = get_feedback_by_id(feedback_id)
-        if not feedback:
-            raise ValueError(f"反馈 {feedback_id} 不存在")
-        
-        now = datetime.now().isoformat()
+        now = _now_iso()
         
+        # 单条 UPDATE ... RETURNING 完成存在性检查、更新和读取（反馈不存在时无返回行）
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 UPDATE feedbacks
                 SET reply = ?, replied_at = ?, updated_at = ?
                 WHERE id = ?
+                RETURNING id, user_id, account, feedback, contact, reply, created_at, updated_at, replied_at
             """, (reply, now, now, feedback_id))
-            
-            logger.info(f"✅ 反馈回复更新成功: {feedback_id}")
+            row = cursor.fetchone()
         
-        return get_feedback_by_id(feedback_id)
+        if not row:
+            raise ValueError(f"反馈 {feedback_id} 不存在")
         
-    except Exception as e:
-        logger.error(f"更新反馈回复失败: {e}")
+        logger.info(f"✅ 反馈回复更新成功: {feedback_id}")
+        
+        return {
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'account': row['account'],
+            'feedback': row['feedback'],
+            'contact': row['contact'],
+            'reply': row['reply'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+            'repliedAt': row['replied_at']
+        }
+        
+    except Exception:
+        logger.exception("更新反馈回复失败")
         return None
 
 
@@ -783,36 +1045,34 @@ def get_user_feedback_count(user_id: str) -> int:
             cursor.execute("SELECT COUNT(*) as count FROM feedbacks WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
             return row['count'] if row else 0
-    except Exception as e:
-        logger.error(f"获取用户反馈数量失败: {e}")
+    except Exception:
+        logger.exception("获取用户反馈数量失败")
         return 0
 
 # ==================== 会话管理函数 ====================
 
-def create_session(session_token: str, user_id: str, expires_at: str) -> bool:
+def create_session(session_token: str, user_id: str, expires_at: Union[int, str]) -> bool:
     """
     创建会话记录（数据库持久化）
     
     Args:
         session_token: 会话令牌
         user_id: 用户ID
-        expires_at: 过期时间
+        expires_at: 过期时间（Unix 时间戳秒；兼容传入 ISO 时间字符串）
         
     Returns:
         创建成功返回 True，失败返回 False
     """
     try:
-        created_at = datetime.now().isoformat()
+        created_at = int(time.time())
+        expires_at = _to_epoch_seconds(expires_at)
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO sessions (session_token, user_id, created_at, expires_at)
-                VALUES (?, ?, ?, ?)
-            """, (session_token, user_id, created_at, expires_at))
+            cursor.execute(_SQL_INSERT_SESSION, (session_token, user_id, created_at, expires_at))
             logger.info(f"✅ 会话创建成功: {session_token[:20]}... (user_id: {user_id})")
         return True
-    except Exception as e:
-        logger.error(f"创建会话失败: {e}")
+    except Exception:
+        logger.exception("创建会话失败")
         return False
 
 
@@ -827,37 +1087,58 @@ def get_user_from_session(session_token: str) -> Optional[Dict]:
         用户信息字典，如果无效返回 None
     """
     try:
-        now = datetime.now().isoformat()
+        now = int(time.time())
+        
+        # 先查进程内缓存，命中且未过期时直接返回副本
+        with _SESSION_CACHE_LOCK:
+            cached = _SESSION_CACHE.get(session_token)
+            if cached is not None:
+                if cached[0] > now:
+                    _SESSION_CACHE.move_to_end(session_token)
+                    return dict(cached[1])
+                del _SESSION_CACHE[session_token]
+        
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # 查询会话
-            cursor.execute("""
-                SELECT user_id, expires_at FROM sessions 
-                WHERE session_token = ? AND expires_at > ?
-            """, (session_token, now))
+            # 会话和用户信息一次 JOIN 查询取回
+            cursor.execute(_SQL_GET_SESSION, (session_token, now))
             
             row = cursor.fetchone()
             if not row:
-                logger.warning(f"⚠️ 会话无效或已过期: {session_token[:20]}...")
+                logger.warning(f"⚠️ 会话无效、已过期或用户不存在: {session_token[:20]}...")
                 return None
             
-            user_id = row['user_id']
-            
-            # 获取用户信息
-            user = get_user_by_id(user_id)
-            if user:
-                logger.info(f"✅ 从会话获取用户: {user.get('account')} (session: {session_token[:20]}...)")
-            else:
-                logger.warning(f"⚠️ 用户不存在: {user_id}")
-            
-            return user
+            user = {
+                'id': row['id'],
+                'account': row['account'],
+                'nickname': row['nickname'],
+                'avatar': row['avatar'],
+                'level': row['level'],
+                'createdAt': row['created_at'],
+                'updatedAt': row['updated_at']
+            }
+            logger.info(f"✅ 从会话获取用户: {user['account']} (session: {session_token[:20]}...)")
+        
+        with _SESSION_CACHE_LOCK:
+            _SESSION_CACHE[session_token] = (row['session_expires_at'], dict(user))
+            if len(_SESSION_CACHE) > _SESSION_CACHE_MAX:
+                _SESSION_CACHE.popitem(last=False)
+        return user
             
-    except Exception as e:
-        logger.error(f"从会话获取用户失败: {e}")
+    except Exception:
+        logger.exception("从会话获取用户失败")
         return None
 
 
+def _invalidate_cached_sessions(user_id: str):
+    """移除某用户的所有缓存会话（用户信息变更后调用，避免返回旧数据）"""
+    with _SESSION_CACHE_LOCK:
+        stale = [token for token, (_, user) in _SESSION_CACHE.items() if user['id'] == user_id]
+        for token in stale:
+            del _SESSION_CACHE[token]
+
+
 def delete_session(session_token: str) -> bool:
     """
     删除会话记录（用户登出）
@@ -871,29 +1152,221 @@ def delete_session(session_token: str) -> bool:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,))
-            logger.info(f"✅ 会话删除成功: {session_token[:20]}...")
+            cursor.execute(_SQL_DELETE_SESSION, (session_token,))
+        with _SESSION_CACHE_LOCK:
+            _SESSION_CACHE.pop(session_token, None)
+        logger.info(f"✅ 会话删除成功: {session_token[:20]}...")
         return True
-    except Exception as e:
-        logger.error(f"删除会话失败: {e}")
+    except Exception:
+        logger.exception("删除会话失败")
         return False
 
 
+# 单次清理删除的最大行数，限制写锁持有时间
+_SESSION_CLEANUP_BATCH = 1000
+_SQL_DELETE_EXPIRED_SESSIONS = """
+                DELETE FROM sessions WHERE rowid IN (
+                    SELECT rowid FROM sessions WHERE expires_at <= ? LIMIT ?
+                )
+            """
+
+
 def delete_expired_sessions() -> int:
     """
     清理过期的会话记录
     
+    按批删除（每批最多 _SESSION_CLEANUP_BATCH 条，各自为一个短事务），
+    WAL 模式下读请求不受影响，写请求也只需等待单个批次
+    
     Returns:
         删除的会话数量
     """
     try:
-        now = datetime.now().isoformat()
+        now = int(time.time())
+        deleted = 0
+        while True:
+            with get_db_connection() as conn:
+                # 立即获取写锁，避免事务中途从读锁升级失败
+                conn.execute("BEGIN IMMEDIATE")
+                cursor = conn.execute(_SQL_DELETE_EXPIRED_SESSIONS, (now, _SESSION_CLEANUP_BATCH))
+                batch = cursor.rowcount
+            deleted += batch
+            if batch < _SESSION_CLEANUP_BATCH:
+                break
+        logger.info(f"✅ 清理过期会话: 删除 {deleted} 条记录")
+        if deleted:
+            # 只移除已过期的缓存项，未过期会话的缓存继续有效
+            with _SESSION_CACHE_LOCK:
+                expired = [token for token, (expires_at, _) in _SESSION_CACHE.items() if expires_at <= now]
+                for token in expired:
+                    del _SESSION_CACHE[token]
+        return deleted
+    except Exception:
+        logger.exception("清理过期会话失败")
+        return 0
+
+
+# 后台会话清理线程
+SESSION_CLEANUP_INTERVAL = 300  # 秒
+_session_cleanup_thread: Optional[threading.Thread] = None
+_session_cleanup_stop = threading.Event()
+
+
+def _session_cleanup_loop(interval: float):
+    """定期清理过期会话和过期聊天历史，直到收到停止信号"""
+    while not _session_cleanup_stop.wait(interval):
+        delete_expired_sessions()
+        delete_expired_chat_messages()
+
+
+def start_session_cleanup(interval: float = SESSION_CLEANUP_INTERVAL):
+    """启动后台过期会话清理线程（重复调用不会创建多个线程）"""
+    global _session_cleanup_thread
+    if _session_cleanup_thread is not None and _session_cleanup_thread.is_alive():
+        return
+    _session_cleanup_stop.clear()
+    _session_cleanup_thread = threading.Thread(
+        target=_session_cleanup_loop,
+        args=(interval,),
+        name="session-cleanup",
+        daemon=True
+    )
+    _session_cleanup_thread.start()
+
+
+def stop_session_cleanup():
+    """停止后台过期会话清理线程（应用关闭时调用）"""
+    global _session_cleanup_thread
+    _session_cleanup_stop.set()
+    if _session_cleanup_thread is not None:
+        _session_cleanup_thread.join(timeout=5)
+        _session_cleanup_thread = None
+
+
+# ==================== 聊天历史函数 ====================
+
+_SQL_GET_CHAT_MESSAGES = """
+                SELECT role, content FROM (
+                    SELECT rowid, ts, role, content FROM chat_messages
+                    WHERE user_id = ? AND session_id = ?
+                    ORDER BY ts DESC, rowid DESC
+                    LIMIT ?
+                )
+                ORDER BY ts, rowid
+            """
+_SQL_INSERT_CHAT_MESSAGE = """
+                INSERT INTO chat_messages (user_id, session_id, ts, role, content) VALUES (?, ?, ?, ?, ?)
+            """
+# 删除会话中最新 N 条之前的消息（LIMIT -1 OFFSET N：跳过最新的 N 条）
+_SQL_PRUNE_CHAT_MESSAGES = """
+                DELETE FROM chat_messages WHERE rowid IN (
+                    SELECT rowid FROM chat_messages
+                    WHERE user_id = ? AND session_id = ?
+                    ORDER BY ts DESC, rowid DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """
+_SQL_OLDEST_CHAT_MESSAGE_TS = "SELECT MIN(ts) FROM chat_messages WHERE user_id = ? AND session_id = ?"
+_SQL_DELETE_EXPIRED_CHAT_MESSAGES = """
+                DELETE FROM chat_messages WHERE rowid IN (
+                    SELECT rowid FROM chat_messages WHERE ts <= ? LIMIT ?
+                )
+            """
+
+# 聊天历史保留时长：超过该时长的消息由后台清理线程删除
+CHAT_MESSAGE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+def get_chat_messages(user_id: str, session_id: str, limit: int = 20) -> List[Dict]:
+    """
+    获取聊天会话最近的消息（按时间正序）
+    
+    Args:
+        user_id: 会话所属用户ID（只能读取自己的会话）
+        session_id: 聊天会话ID
+        limit: 最多返回的消息条数
+        
+    Returns:
+        [{'role': ..., 'content': ...}, ...]，与前端传入的 history 格式相同
+    """
+    try:
         with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
-            deleted = cursor.rowcount
-            logger.info(f"✅ 清理过期会话: 删除 {deleted} 条记录")
+            cursor = conn.execute(_SQL_GET_CHAT_MESSAGES, (user_id, session_id, limit))
+            return [{'role': role, 'content': content} for role, content in cursor]
+    except Exception:
+        logger.exception("获取聊天历史失败")
+        return []
+
+
+def add_chat_messages(
+    user_id: str,
+    session_id: str,
+    messages: List[Dict],
+    max_messages: Optional[int] = None,
+    summary: Optional[str] = None,
+    keep: int = 0
+) -> bool:
+    """
+    追加聊天消息（一次事务写入一轮对话的全部消息）
+    
+    Args:
+        user_id: 会话所属用户ID
+        session_id: 聊天会话ID
+        messages: [{'role': ..., 'content': ...}, ...]，按时间顺序
+        max_messages: 会话最多保留的消息条数（可选），写入后在同一事务中删除更早的消息
+        summary: 历史摘要（可选）。提供时先把最新 keep 条之前的消息替换为这一条摘要，再写入 messages
+        keep: 与 summary 一起使用，摘要之后保留原文的消息条数
+        
+    Returns:
+        写入成功返回 True，失败返回 False
+    """
+    try:
+        ts = time.time_ns() // 1_000_000
+        with get_db_connection() as conn:
+            if summary is not None:
+                conn.execute(_SQL_PRUNE_CHAT_MESSAGES, (user_id, session_id, keep))
+                # 摘要排在保留的消息之前
+                oldest = conn.execute(_SQL_OLDEST_CHAT_MESSAGE_TS, (user_id, session_id)).fetchone()[0]
+                conn.execute(
+                    _SQL_INSERT_CHAT_MESSAGE,
+                    (user_id, session_id, (ts if oldest is None else oldest) - 1, 'user', summary)
+                )
+            conn.executemany(
+                _SQL_INSERT_CHAT_MESSAGE,
+                [(user_id, session_id, ts, m['role'], m['content']) for m in messages]
+            )
+            if max_messages is not None:
+                conn.execute(_SQL_PRUNE_CHAT_MESSAGES, (user_id, session_id, max_messages))
+        return True
+    except Exception:
+        logger.exception("保存聊天历史失败")
+        return False
+
+
+def delete_expired_chat_messages(max_age: int = CHAT_MESSAGE_TTL_SECONDS) -> int:
+    """
+    清理超过保留时长的聊天消息（按批删除，与 delete_expired_sessions 相同）
+    
+    Args:
+        max_age: 保留时长（秒）
+        
+    Returns:
+        删除的消息数量
+    """
+    try:
+        cutoff = (int(time.time()) - max_age) * 1000
+        deleted = 0
+        while True:
+            with get_db_connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                cursor = conn.execute(_SQL_DELETE_EXPIRED_CHAT_MESSAGES, (cutoff, _SESSION_CLEANUP_BATCH))
+                batch = cursor.rowcount
+            deleted += batch
+            if batch < _SESSION_CLEANUP_BATCH:
+                break
+        if deleted:
+            logger.info(f"✅ 清理过期聊天历史: 删除 {deleted} 条消息")
         return deleted
-    except Exception as e:
-        logger.error(f"清理过期会话失败: {e}")
+    except Exception:
+        logger.exception("清理过期聊天历史失败")
         return 0
@@ -7,10 +7,13 @@ Gemini 2.5 Flash Image 图片生成器 (重构版)
 import os
 import base64
 import logging
-import traceback
 import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, NamedTuple
 from PIL import Image
 
 # 结构化日志工具
@@ -18,22 +21,32 @@ import sys
 backend_dir = Path(__file__).parent.parent
 if str(backend_dir) not in sys.path:
     sys.path.insert(0, str(backend_dir))
-from log_utils import log_info, log_debug, log_warning, log_error, log_success
+from log_utils import log_info, log_warning, log_error, log_success
 
 # ==================== 配置模块 ====================
+class EnvSnapshot(NamedTuple):
+    """加载 .env 后的环境变量快照（请求路径只读快照，不再逐个 os.getenv）"""
+    vertex_project: str
+    vertex_location: str
+    credentials: Optional[str]
+    disable_proxy: bool
+    is_cloud: bool
+    proxy_url: str
+
+
 class EnvConfig:
     """环境变量和配置管理（单一职责）"""
     
     @staticmethod
-    def load_env():
-        """加载环境变量（.env 文件）"""
+    def load_env(override: bool = False):
+        """加载环境变量（.env 文件；设置了 BANANA_ENV 时直接加载该路径，跳过 find_dotenv 的目录遍历）"""
         try:
             from dotenv import load_dotenv, find_dotenv
-            env_file = find_dotenv() or EnvConfig._find_backend_env()
+            env_file = os.environ.get('BANANA_ENV') or find_dotenv() or EnvConfig._find_backend_env()
             if env_file:
-                load_dotenv(dotenv_path=env_file, override=False)
+                load_dotenv(dotenv_path=env_file, override=override)
                 return env_file
-            load_dotenv(override=False)
+            load_dotenv(override=override)
         except ImportError:
             pass
         return None
@@ -48,18 +61,36 @@ class EnvConfig:
         return None
     
     @staticmethod
-    def should_use_proxy() -> bool:
-        """判断是否使用代理"""
+    def snapshot() -> EnvSnapshot:
+        """读取一次当前环境变量并生成快照"""
+        env = os.environ
+        return EnvSnapshot(
+            vertex_project=(env.get("VERTEX_AI_PROJECT") or env.get("GOOGLE_CLOUD_PROJECT") or "").strip(),
+            vertex_location=(env.get("VERTEX_AI_LOCATION", "global") or "").strip(),
+            credentials=env.get("GOOGLE_APPLICATION_CREDENTIALS"),
+            disable_proxy=env.get('DISABLE_PROXY', '').lower() == 'true',
+            is_cloud=bool(env.get('K_SERVICE') or env.get('GAE_ENV')),
+            proxy_url=(env.get('HTTP_PROXY') or env.get('HTTPS_PROXY') or
+                       f"http://{env.get('PROXY_HOST', '127.0.0.1')}:{env.get('PROXY_PORT', '29290')}"),
+        )
+    
+    @staticmethod
+    def should_use_proxy(refresh: bool = False) -> bool:
+        """判断是否使用代理（结果记忆化，首次调用时才配置代理环境变量；refresh=True 时重新判断）"""
+        global _use_proxy
+        if _use_proxy is not None and not refresh:
+            return _use_proxy
+        
         # 优先级：DISABLE_PROXY > Cloud环境 > HTTP
-        if os.getenv('DISABLE_PROXY', '').lower() == 'true':
+        if _ENV.disable_proxy:
             ProxyConfig.clear_proxy_env()
-            return False
-        
-        if os.getenv('K_SERVICE') or os.getenv('GAE_ENV'):
-            return False
-        
-        # HTTP 代理
-        return ProxyConfig.setup_http()
+            _use_proxy = False
+        elif _ENV.is_cloud:
+            _use_proxy = False
+        else:
+            # HTTP 代理
+            _use_proxy = ProxyConfig.setup_http()
+        return _use_proxy
 
 
 class ProxyConfig:
@@ -74,19 +105,32 @@ class ProxyConfig:
     @staticmethod
     def setup_http() -> bool:
         """配置 HTTP 代理"""
-        proxy_url = (os.getenv('HTTP_PROXY') or os.getenv('HTTPS_PROXY') or 
-                     f"http://{os.getenv('PROXY_HOST', '127.0.0.1')}:{os.getenv('PROXY_PORT', '29290')}")
         for key in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy']:
-            os.environ[key] = proxy_url
+            os.environ[key] = _ENV.proxy_url
         return True
 
 
 # ==================== 初始化 ====================
 logger = logging.getLogger("果捷后端")
-env_file = EnvConfig.load_env()
-if env_file:
-    logger.info(f"✅ [gemini_2_5_flash_image] 已加载环境: {env_file}")
-EnvConfig.should_use_proxy()
+
+# .env 每个进程只加载一次；标记写在环境变量里，模块被重新导入或 fork 出的 worker 继承后不再重复加载
+_ENV_LOADED_FLAG = '_BANANA_ENV_LOADED'
+if not os.environ.get(_ENV_LOADED_FLAG):
+    env_file = EnvConfig.load_env()
+    os.environ[_ENV_LOADED_FLAG] = '1'
+    if env_file:
+        logger.info("✅ [gemini_2_5_flash_image] 已加载环境: %s", env_file)
+_ENV = EnvConfig.snapshot()
+# 代理判断推迟到首次创建 Client 时，导入模块不修改代理环境变量
+_use_proxy: Optional[bool] = None
+
+
+def _refresh_env():
+    """重新读取环境变量快照（测试或运行期修改环境变量后调用）"""
+    global _ENV
+    _ENV = EnvConfig.snapshot()
+    return _ENV
+
 
 # 导入 google.genai
 try:
@@ -99,9 +143,26 @@ except ImportError:
 
 
 # ==================== 客户端管理 ====================
+# 进程内复用的 Client（复用底层 HTTP 连接池，避免每个请求重新读取凭据、建立 TLS 连接）
+_client = None
+_client_lock = threading.Lock()
+
+
 class GeminiClient:
     """Gemini Client 管理（单一职责）"""
     
+    @staticmethod
+    def get():
+        """获取复用的 Gemini Client（双重检查加锁，只创建一次；创建失败返回 None，下次调用重试）"""
+        global _client
+        if _client is not None:
+            return _client
+        with _client_lock:
+            if _client is None:
+                EnvConfig.should_use_proxy()
+                _client = GeminiClient.create()
+            return _client
+    
     @staticmethod
     def create():
         """创建 Gemini Client"""
@@ -109,8 +170,8 @@ class GeminiClient:
             return None
         
         # 获取配置
-        project_id = (os.getenv("VERTEX_AI_PROJECT") or os.getenv("GOOGLE_CLOUD_PROJECT") or "").strip()
-        location = (os.getenv("VERTEX_AI_LOCATION", "global") or "").strip()
+        project_id = _ENV.vertex_project
+        location = _ENV.vertex_location
         credentials = GeminiClient._resolve_credentials()
         
         if not project_id:
@@ -137,14 +198,18 @@ class GeminiClient:
             log_success("Client创建", f"Vertex AI Client初始化成功", {"项目": project_id})
             return client
         except Exception as e:
-            log_error("Client创建", f"创建失败: {e}")
+            logger.error("❌ [Client创建] 创建失败: %s", e, exc_info=True)
             return None
     
     @staticmethod
     def _resolve_credentials() -> Optional[str]:
-        """解析凭据路径（支持相对路径和自动查找）"""
-        credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        
+        """解析凭据路径（支持相对路径和自动查找；结果按凭据配置和工作目录缓存）"""
+        return GeminiClient._resolve_credentials_for(_ENV.credentials, os.getcwd())
+    
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def _resolve_credentials_for(credentials: Optional[str], cwd: str) -> Optional[str]:
+        """按给定配置查找凭据文件（多次 stat，进程内结果不变，由 lru_cache 缓存）"""
         # 如果是相对路径，转为绝对路径
         if credentials and not os.path.isabs(credentials):
             backend_root = Path(__file__).parent.parent
@@ -161,7 +226,7 @@ class GeminiClient:
         for key_path in [
             current.parent.parent / 'google-key.json',  # backend/
             current.parent.parent.parent / 'google-key.json',  # 项目根
-            Path(os.getcwd()) / 'google-key.json'  # 容器根
+            Path(cwd) / 'google-key.json'  # 容器根
         ]:
             if key_path.exists():
                 log_info("凭证查找", f"找到 google-key.json: {key_path}")
@@ -171,87 +236,202 @@ class GeminiClient:
         return None
 
 
+def reload_config():
+    """
+    重新加载 .env 和环境变量快照（运行期轮换配置时显式调用）
+    
+    .env 中的值覆盖当前环境变量，重新判断代理，并丢弃已缓存的 Client，下次请求按新配置创建
+    """
+    global _client
+    env_file = EnvConfig.load_env(override=True)
+    _refresh_env()
+    GeminiClient._resolve_credentials_for.cache_clear()
+    EnvConfig.should_use_proxy(refresh=True)
+    with _client_lock:
+        _client = None
+    log_info("配置重载", f"已重新加载环境: {env_file or '系统环境变量'}", emoji="🔄")
+
+
 # ==================== 图片处理工具 ====================
+# 图片文件签名（完整 8 字节 PNG 签名比 4 字节前缀误判更少）
+_PNG_SIG = b'\x89PNG\r\n\x1a\n'
+_JPEG_SOI = b'\xff\xd8\xff'
+# PNG / JPEG 文件头 base64 编码后的文本前缀
+_B64_IMAGE_PREFIXES = (b'iVBOR', b'/9j/')
+# 模型只返回 PNG / JPEG，打开响应图片时只尝试这两个插件，跳过其余格式的探测
+_RESPONSE_IMAGE_FORMATS = ('PNG', 'JPEG')
+# 合法的响应 MIME 类型 -> 格式名（同时限定了返回给前端的取值范围）
+_MIME_TO_FMT = {'image/png': 'png', 'image/jpeg': 'jpeg'}
+
+# 参考图编码线程池（PIL 编码时释放 GIL，多张参考图可并行编码）
+MAX_REFERENCE_IMAGES = 3
+# 参考图长边上限（与模型 1K 输出分辨率一致），超出时先缩小再上传
+MAX_REFERENCE_EDGE = 1024
+_encode_pool: Optional[ThreadPoolExecutor] = None
+_encode_pool_lock = threading.Lock()
+
+
+def _get_encode_pool() -> ThreadPoolExecutor:
+    """获取参考图编码线程池（首次使用时创建）"""
+    global _encode_pool
+    if _encode_pool is None:
+        with _encode_pool_lock:
+            if _encode_pool is None:
+                _encode_pool = ThreadPoolExecutor(
+                    max_workers=MAX_REFERENCE_IMAGES,
+                    thread_name_prefix="ref-image-encode"
+                )
+    return _encode_pool
+
+
+class _LazyHex:
+    """日志参数：只有记录真正被输出时才生成前 n 字节的 hex 字符串"""
+    __slots__ = ('data', 'n')
+    
+    def __init__(self, data: bytes, n: int = 16):
+        self.data = data
+        self.n = n
+    
+    def __str__(self) -> str:
+        return self.data[:self.n].hex()
+
+
+def _normalize_image_payload(raw) -> bytes:
+    """
+    将 inline_data.data 统一为原始图片 bytes
+    
+    str 一律视为 base64 文本；bytes 只比较开头的 base64 文件头前缀（PNG→iVBOR、JPEG→/9j/），
+    命中才解码一次，其余按原始二进制直接返回，不做整段文本转换
+    """
+    if isinstance(raw, str) or raw.startswith(_B64_IMAGE_PREFIXES):
+        return base64.b64decode(raw)
+    return raw
+
+
+class ImageInfo(NamedTuple):
+    """一次解析得到的图片信息"""
+    valid: bool
+    mime_type: str
+    format: str
+    width: int
+    height: int
+
+
+_INVALID_IMAGE = ImageInfo(False, 'image/png', 'png', 0, 0)
+
+
 class ImageProcessor:
     """图片处理工具（单一职责）"""
     
+    @staticmethod
+    def inspect(image_bytes: bytes) -> ImageInfo:
+        """
+        只打开一次图片，得到格式、尺寸和有效性
+        
+        格式和尺寸直接取自文件头；完整性校验按格式选择最便宜的方式：
+        - PNG：verify() 逐块校验 CRC，不解压 IDAT（完整 load 要慢一个数量级）
+        - JPEG：verify() 不检查任何数据，截断的文件也能通过；改用 draft() 让 libjpeg 按 1/8 比例解码后 load()
+        """
+        try:
+            img = Image.open(io.BytesIO(image_bytes), formats=_RESPONSE_IMAGE_FORMATS)
+            format_name = 'jpeg' if img.format == 'JPEG' else 'png'
+            width, height = img.size
+            if format_name == 'jpeg':
+                img.draft('RGB', (1, 1))
+                img.load()
+            else:
+                img.verify()
+        except Exception:
+            return _INVALID_IMAGE
+        return ImageInfo(True, f'image/{format_name}', format_name, width, height)
+    
+    @staticmethod
+    def detect_format_fast(image_bytes: bytes) -> Optional[str]:
+        """仅凭 magic bytes 识别 PNG/JPEG（返回 MIME 类型，无法识别返回 None，不调用 PIL）"""
+        if image_bytes.startswith(_PNG_SIG):
+            return 'image/png'
+        if image_bytes.startswith(_JPEG_SOI):
+            return 'image/jpeg'
+        return None
+    
     @staticmethod
     def detect_format(image_bytes: bytes) -> str:
         """检测图片格式（返回 MIME 类型）"""
         if not image_bytes or len(image_bytes) < 4:
             return 'image/png'
         
-        # 优先使用 PIL
+        # 优先使用 magic bytes（几次字节比较即可确定格式，无需解码像素）
+        mime_type = ImageProcessor.detect_format_fast(image_bytes)
+        if mime_type:
+            return mime_type
+
+        # 回退到 PIL（Image.open 只解析文件头即可得到 format，不调用 load()）
         try:
             img = Image.open(io.BytesIO(image_bytes))
-            img.load()
             if img.format:
                 fmt = img.format.lower()
-                log_info("格式检测", f"PIL识别: {fmt} ({img.size[0]}x{img.size[1]})", emoji="✅")
-                return 'image/jpeg' if fmt in ['jpeg', 'jpg'] else 'image/png'
+                if logger.isEnabledFor(logging.INFO):
+                    log_info("格式检测", f"PIL识别: {fmt} ({img.size[0]}x{img.size[1]})", emoji="✅")
+                return 'image/jpeg' if fmt in ('jpeg', 'jpg') else 'image/png'
         except Exception as e:
-            log_warning("格式检测", f"PIL失败: {e}")
-        
-        # 回退到 magic bytes
-        if image_bytes[:4] == b'\x89PNG':
-            return 'image/png'
-        if image_bytes[:3] == b'\xFF\xD8\xFF':
-            return 'image/jpeg'
-        
+            logger.warning("⚠️ [格式检测] PIL失败: %s, 前16字节(hex): %s", e, _LazyHex(image_bytes))
+
         return 'image/png'
     
     @staticmethod
     def extract_from_response(response) -> Optional[Tuple[bytes, str]]:
         """从响应中提取图片数据"""
         try:
-            if not hasattr(response, 'candidates') or not response.candidates:
-                log_warning("图片提取", "response.candidates 为空，可能被安全过滤")
-                return None
-            
-            candidate = response.candidates[0]
-            if not hasattr(candidate, 'content') or not candidate.content.parts:
-                log_warning("图片提取", "candidate.content.parts 为空，无法提取图片")
-                return None
-            
-            for part in candidate.content.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 确保是 bytes
-                    if isinstance(data, str):
-                        try:
-                            data = base64.b64decode(data)
-                        except:
-                            continue
-                    
-                    if isinstance(data, bytes):
-                        return data, mime_type
-            
+            parts = response.candidates[0].content.parts
+            inline = parts[0].inline_data
+        except (AttributeError, IndexError, TypeError):
+            log_warning("图片提取", "响应中没有 candidates/parts，可能被安全过滤")
             return None
+        
+        try:
+            # 常见情况第一个 part 就是图片，否则再向后查找图片 part
+            if not inline:
+                inline = next((part.inline_data for part in parts[1:] if part.inline_data), None)
+                if inline is None:
+                    log_warning("图片提取", "响应 parts 中没有 inline_data 图片")
+                    return None
+            
+            return _normalize_image_payload(inline.data), inline.mime_type
         except Exception as e:
             log_error("图片提取", f"提取失败: {e}")
             return None
     
     @staticmethod
-    def encode_pil_to_bytes(image: Image.Image, format: str = 'JPEG', quality: int = 85) -> bytes:
-        """将 PIL Image 编码为 bytes"""
+    def encode_pil_to_bytes(image: Image.Image, format: str = 'JPEG', quality: int = 85,
+                            max_edge: Optional[int] = None) -> bytes:
+        """将 PIL Image 编码为 bytes（指定 max_edge 时按比例缩小到长边不超过该值）"""
         buffer = io.BytesIO()
-        if image.mode != 'RGB' and format.upper() == 'JPEG':
+        # JPEG 可直接保存 RGB / L，只有其他模式（P、CMYK 等）才需要整图转换
+        if image.mode not in ('RGB', 'L') and format.upper() == 'JPEG':
             image = image.convert('RGB')
+        if max_edge and max(image.size) > max_edge:
+            scale = max_edge / max(image.size)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
         image.save(buffer, format=format, quality=quality)
-        buffer.seek(0)
         return buffer.getvalue()
     
     @staticmethod
-    def validate(image_bytes: bytes) -> bool:
-        """验证图片数据是否有效"""
-        try:
-            img = Image.open(io.BytesIO(image_bytes))
-            img.verify()
-            return True
-        except:
-            return False
+    def reference_to_bytes(image: Image.Image) -> Tuple[bytes, str]:
+        """
+        参考图转为 (bytes, mime_type)
+        
+        上传后未解码、未修改且不超过 MAX_REFERENCE_EDGE 的 JPEG/PNG 仍持有原始字节流，直接复用，
+        省去一次解码 + JPEG 重新编码；其他情况（大图、已 load、内存中生成或转换过的图片）才缩小并重新编码：
+        带透明通道的保存为 PNG（保留 alpha，省去整图转 RGB 的像素拷贝），其余编码为 JPEG
+        """
+        fp = getattr(image, 'fp', None)
+        if (image.format in ('JPEG', 'PNG') and isinstance(fp, io.BytesIO)
+                and max(image.size) <= MAX_REFERENCE_EDGE):
+            return fp.getvalue(), 'image/jpeg' if image.format == 'JPEG' else 'image/png'
+        if image.mode in ('RGBA', 'LA'):
+            return ImageProcessor.encode_pil_to_bytes(image, format='PNG', max_edge=MAX_REFERENCE_EDGE), 'image/png'
+        return ImageProcessor.encode_pil_to_bytes(image, max_edge=MAX_REFERENCE_EDGE), 'image/jpeg'
 
 
 # ==================== 提示词优化 ====================
@@ -285,6 +465,36 @@ class PromptOptimizer:
 
 
 # ==================== 主要生成函数 ====================
+def _finalize_image_response(image_bytes: bytes, mime_type: Optional[str]) -> dict:
+    """
+    校验提取到的图片数据并组装返回字典
+    
+    类型检查在前，随后只解析一次图片得到格式和尺寸；失败时返回错误字典
+    """
+    if not isinstance(image_bytes, bytes):
+        log_error("验证失败", f"image_bytes 类型错误: {type(image_bytes)}")
+        return {"error": True, "error_type": "InvalidImageType",
+                "error_message": f"image_bytes 必须是 bytes，实际为 {type(image_bytes)}"}
+    
+    info = ImageProcessor.inspect(image_bytes)
+    if not info.valid:
+        return {"error": True, "error_type": "InvalidImage",
+                "error_message": "生成的图片数据无效"}
+    
+    # 响应声明的 MIME 不是 PNG/JPEG 或与实际格式不一致时，以解析结果为准
+    if _MIME_TO_FMT.get(mime_type) != info.format:
+        mime_type = info.mime_type
+    
+    # 返回新架构格式：image_bytes + 元数据（所有字段都是可序列化的）
+    return {
+        "image_bytes": image_bytes,  # bytes
+        "mime_type": mime_type,  # str
+        "format": info.format,  # str
+        "width": info.width,  # int
+        "height": info.height  # int
+    }
+
+
 def generate_with_gemini_2_5_flash_image(
     prompt: str,
     reference_images: Optional[List[Image.Image]] = None,
@@ -305,21 +515,20 @@ def generate_with_gemini_2_5_flash_image(
         return {"error": True, "error_type": "ModuleNotAvailable", 
                 "error_message": "google.genai 模块不可用"}
     
-    client = GeminiClient.create()
+    client = GeminiClient.get()
     if not client:
         return {"error": True, "error_type": "ClientCreationFailed",
                 "error_message": "无法创建 Client"}
     
+    # 生产环境通常为 WARNING 级别，此时跳过日志字符串的拼接；
+    # 各步骤不单独打日志，耗时等信息汇总到成功时的一条记录里
+    verbose = logger.isEnabledFor(logging.INFO)
+    
     try:
         # 构建内容
         has_reference = reference_images and len(reference_images) > 0
         mode_str = "图生图" if has_reference else "文生图"
-        
-        log_info("Gemini 2.5", f"开始 {mode_str} 生成", emoji="🖼️")
-        log_debug("请求参数", f"提示词: {prompt[:50]}...", {
-            "参考图": len(reference_images) if has_reference else 0,
-            "长宽比": aspect_ratio or "默认"
-        })
+        started = time.perf_counter()
         
         # 优化提示词
         optimized_prompt = PromptOptimizer.optimize_for_image(
@@ -332,10 +541,13 @@ def generate_with_gemini_2_5_flash_image(
         
         # 添加参考图（最多 3 张）
         if has_reference:
-            for idx, ref_img in enumerate(reference_images[:3]):
-                img_bytes = ImageProcessor.encode_pil_to_bytes(ref_img)
-                parts.append(types.Part.from_bytes(data=img_bytes, mime_type="image/jpeg"))
-                log_debug("参考图", f"添加第 {idx+1} 张参考图", {"大小": f"{len(img_bytes)} bytes"})
+            refs = reference_images[:MAX_REFERENCE_IMAGES]
+            if len(refs) > 1:
+                encoded = list(_get_encode_pool().map(ImageProcessor.reference_to_bytes, refs))
+            else:
+                encoded = [ImageProcessor.reference_to_bytes(refs[0])]
+            for img_bytes, img_mime in encoded:
+                parts.append(types.Part.from_bytes(data=img_bytes, mime_type=img_mime))
         
         # 配置
         config_params = {
@@ -350,13 +562,13 @@ def generate_with_gemini_2_5_flash_image(
         config = types.GenerateContentConfig(**config_params)
         
         # 调用 API
-        log_info("API调用", "发送请求到 Google...", emoji="📤")
+        api_started = time.perf_counter()
         response = client.models.generate_content(
             model='gemini-2.5-flash-image',
             contents=[types.Content(parts=parts, role='user')],
             config=config
         )
-        log_info("API调用", "模型调用完成", emoji="✅")
+        api_finished = time.perf_counter()
         
         # 提取图片
         result = ImageProcessor.extract_from_response(response)
@@ -365,53 +577,26 @@ def generate_with_gemini_2_5_flash_image(
                     "error_message": "响应中没有图片数据"}
         
         image_bytes, mime_type = result
-        
-        # 验证图片
-        if not ImageProcessor.validate(image_bytes):
-            return {"error": True, "error_type": "InvalidImage",
-                    "error_message": "生成的图片数据无效"}
-        
-        # 检测格式
-        detected_format = ImageProcessor.detect_format(image_bytes)
-        format_name = 'jpeg' if 'jpeg' in detected_format else 'png'
-        
-        # 获取图片尺寸
-        try:
-            from PIL import Image
-            import io
-            img = Image.open(io.BytesIO(image_bytes))
-            width, height = img.size
-        except:
-            width, height = 0, 0
-        
-        log_success("生成完成", f"Gemini 2.5 {mode_str} 成功", {
-            "大小": f"{len(image_bytes)} bytes ({len(image_bytes)/1024:.1f} KB)",
-            "格式": format_name
-        })
-        
-        # 验证 image_bytes 类型
-        if not isinstance(image_bytes, bytes):
-            log_error("验证失败", f"image_bytes 类型错误: {type(image_bytes)}")
-            return {"error": True, "error_type": "InvalidImageType",
-                    "error_message": f"image_bytes 必须是 bytes，实际为 {type(image_bytes)}"}
-        
-        log_info("序列化检查", "返回数据已验证为可序列化", emoji="✅")
-        
-        # 返回新架构格式：image_bytes + 元数据（所有字段都是可序列化的）
-        return {
-            "image_bytes": image_bytes,  # bytes
-            "mime_type": mime_type or f"image/{format_name}",  # str
-            "format": format_name,  # str
-            "width": width,  # int
-            "height": height  # int
-        }
+        image_data = _finalize_image_response(image_bytes, mime_type)
+        
+        if verbose and not image_data.get("error"):
+            size = len(image_bytes)
+            log_success("生成完成", f"Gemini 2.5 {mode_str} 成功", {
+                "大小": f"{size} bytes ({size / 1024:.1f} KB)",
+                "格式": image_data["format"],
+                "尺寸": f"{image_data['width']}x{image_data['height']}",
+                "参考图": len(reference_images) if has_reference else 0,
+                "长宽比": aspect_ratio or "默认",
+                "准备耗时": f"{(api_started - started) * 1000:.0f}ms",
+                "API耗时": f"{(api_finished - api_started) * 1000:.0f}ms"
+            })
+        return image_data
         
     except Exception as e:
         error_type = type(e).__name__
         error_message = str(e)
-        log_error("生成失败", f"Gemini 2.5 错误: {error_message}")
-        logger.error(f"异常类型: {error_type}")
-        logger.error(f"完整堆栈:\n{traceback.format_exc()}")
+        # exc_info 交给日志处理器在真正输出时再格式化堆栈
+        logger.error("❌ [生成失败] Gemini 2.5 错误 (%s): %s", error_type, error_message, exc_info=True)
         
         # ⚠️ 重要：不要在返回的字典中包含 traceback，因为它可能包含对象引用导致序列化失败
         return {
@@ -4,25 +4,225 @@
 使用 Gemini 3 Flash Preview (gemini-3-flash-preview) 模型进行文本聊天
 支持多模态输入：文本 + 可选参考图片
 """
+import re
 import time
+import asyncio
 import logging
-import traceback
+import threading
 import base64
 import io
-from typing import List, Optional, Union
+import json
+import hashlib
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 from pathlib import Path
 
+# 依赖 google-genai 的 Client / types / errors；未安装时直接导入失败，不再退回旧版 SDK
+from google import genai
+from google.genai import types
+from google.genai import errors as genai_errors
+import httpx
+
+# orjson 序列化更快（直接返回 bytes），未安装时使用标准库 json
 try:
-    from google import genai
-    from google.genai import types
+    import orjson
 except ImportError:
-    import google.generativeai as genai
-    from google.api_core import exceptions as gexceptions
+    orjson = None
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_exponential_jitter,
+)
 
-import google.api_core.exceptions as gexceptions
+from database import get_chat_messages, add_chat_messages
 
 logger = logging.getLogger("果捷后端")
 
+MODEL_NAME = 'gemini-3-flash-preview'
+
+# 面向用户的错误提示
+_MSG_TIMEOUT = "抱歉，请求超时，可能是网络问题。请检查网络连接后重试。"
+_MSG_UNAVAILABLE = "抱歉，AI 服务暂时不可用，请稍后重试。"
+_MSG_CONNECT = "抱歉，无法连接到 AI 服务，请检查网络连接。"
+_MSG_RATE_LIMIT = "抱歉，请求过于频繁，请稍后重试。"
+_MSG_EMPTY = "抱歉，AI 返回了空响应，请重试。"
+_MSG_GENERIC = "抱歉，处理请求时出错。如果问题持续，请联系技术支持。"
+
+# 进程内复用的 Gemini 客户端（首次使用时创建）
+_client = None
+_client_lock = threading.Lock()
+# 客户端创建失败的时间，短时间内不再重试创建
+_client_failed_at = 0.0
+_CLIENT_RETRY_INTERVAL = 30  # 秒
+
+
+# 回复缓存：key -> (过期时间 monotonic, 回复文本)，按 LRU 淘汰
+# 只缓存确定性请求（temperature=0 且不带图片），其他情况相同输入本就期望得到不同回复
+_RESPONSE_CACHE: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+_RESPONSE_CACHE_MAX = 10000
+_RESPONSE_CACHE_TTL = 3600  # 秒
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+# 归一化时去掉的首尾标点与空白
+_TRIM_CHARS = ' \t\r\n.。!！?？,，~～…'
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _normalize_message(message: str) -> str:
+    """
+    归一化消息文本，使仅有大小写、空白或首尾标点差异的消息得到同一缓存键
+    
+    例如 "Hello  World!" 与 "hello world" 视为相同问题
+    """
+    return _WHITESPACE_RE.sub(' ', message).strip(_TRIM_CHARS).casefold()
+
+
+# 无需调用模型即可回复的常见消息（归一化后精确匹配，仅用于对话的第一条纯文本消息）
+_GREETING_REPLY = "你好！我是 AI 助手，有什么可以帮你的吗？"
+_THANKS_REPLY = "不客气！还有其他问题随时问我。"
+_TEMPLATE_REPLIES = {
+    **dict.fromkeys(('你好', '您好', '你好呀', '嗨', '哈喽', '在吗', '在不在', 'hi', 'hello', 'hey'), _GREETING_REPLY),
+    **dict.fromkeys(('谢谢', '谢谢你', '感谢', '多谢', 'thanks', 'thank you', 'thx'), _THANKS_REPLY),
+}
+
+# 回复来源计数：template（模板）/ cache（回复缓存）/ model（实际发起的模型调用）/
+# coalesced（合并到进行中的相同请求，不产生新的模型调用）
+_route_stats = Counter()
+
+
+def get_route_stats() -> Dict[str, int]:
+    """获取聊天回复来源计数（用于观察模板、缓存与请求合并的命中比例）"""
+    return dict(_route_stats)
+
+
+def _template_reply(message: str, history: Optional[List], image_data) -> Optional[str]:
+    """对话开头的问候/致谢等简单消息直接返回模板回复，不匹配时返回 None"""
+    if history or image_data:
+        return None
+    return _TEMPLATE_REPLIES.get(_normalize_message(message))
+
+
+def _response_cache_key(message: str, history: Optional[List]) -> bytes:
+    """根据历史记录和当前消息（归一化后）计算缓存键"""
+    data = [history or [], _normalize_message(message)]
+    try:
+        payload = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    except (AttributeError, TypeError):
+        # orjson 未安装，或 history 中含 orjson 不支持的值（如超出 64 位的整数）
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def _response_cache_get(key: bytes) -> Optional[str]:
+    """读取未过期的缓存回复"""
+    with _RESPONSE_CACHE_LOCK:
+        cached = _RESPONSE_CACHE.get(key)
+        if cached is None:
+            return None
+        if cached[0] <= time.monotonic():
+            del _RESPONSE_CACHE[key]
+            return None
+        _RESPONSE_CACHE.move_to_end(key)
+        return cached[1]
+
+
+def _response_cache_put(key: bytes, text: str):
+    """写入缓存回复，超出容量时淘汰最久未使用的项"""
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (time.monotonic() + _RESPONSE_CACHE_TTL, text)
+        _RESPONSE_CACHE.move_to_end(key)
+        if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+# 历史记录裁剪：超过 SUMMARY_TRIGGER 条消息时，较早的消息压缩为一条摘要，
+# 末尾至少保留 MAX_HISTORY_TURNS 条原文。摘要按整块（SUMMARY_TRIGGER - MAX_HISTORY_TURNS 条）
+# 推进，块内新增消息不会改变摘要，摘要可命中缓存，请求前缀也保持稳定
+MAX_HISTORY_TURNS = 10
+SUMMARY_TRIGGER = 30
+_SUMMARY_BLOCK = SUMMARY_TRIGGER - MAX_HISTORY_TURNS
+
+# 服务端保存聊天历史时，每次请求读取的最近消息条数；写入时同时删除更早的消息。
+# 每轮写入 2 条，读取上限为 SUMMARY_TRIGGER + 2，保证超过 SUMMARY_TRIGGER 条时能读到并触发摘要，
+# 摘要写回数据库替换被压缩的消息（见 _save_turn），不会在摘要前被截断丢弃
+CHAT_HISTORY_LIMIT = SUMMARY_TRIGGER + 2
+
+
+async def _load_history(user_id: str, session_id: str) -> List:
+    """读取用户某个聊天会话最近的历史消息（SQLite 查询放到线程中执行）"""
+    return await asyncio.to_thread(get_chat_messages, user_id, session_id, CHAT_HISTORY_LIMIT)
+
+
+async def _save_turn(
+    user_id: str,
+    session_id: str,
+    message: str,
+    reply: str,
+    trimmed: Optional[Tuple[List, Optional[str]]] = None
+):
+    """
+    保存一轮问答到用户的聊天会话历史
+    
+    trimmed 为 _trim_history 对服务端历史的裁剪结果；生成了新摘要时，
+    在写入本轮问答的同一事务中，把最近保留原文的消息之前的记录替换为这条摘要
+    """
+    summary, keep = None, 0
+    if trimmed is not None and trimmed[1] is not None:
+        summary, keep = trimmed[1], len(trimmed[0]) - 1
+    await asyncio.to_thread(
+        add_chat_messages,
+        user_id,
+        session_id,
+        [{'role': 'user', 'content': message}, {'role': 'model', 'content': reply}],
+        CHAT_HISTORY_LIMIT,
+        summary,
+        keep
+    )
+
+
+def _create_async_http_client():
+    """
+    创建所有聊天请求共享的 httpx 异步客户端
+    
+    连接池保持长连接，后续请求复用已建立的 TLS 连接，省去每次握手；
+    代理沿用 HTTPS_PROXY / ALL_PROXY 等环境变量（trust_env）
+    """
+    limits = httpx.Limits(
+        max_connections=200,
+        max_keepalive_connections=50,
+        keepalive_expiry=300.0
+    )
+    timeout = httpx.Timeout(timeout=300.0, connect=30.0)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+def _get_client():
+    """
+    获取复用的 Gemini 客户端（双重检查加锁，只创建一次）
+    
+    创建失败时返回 None，并在 _CLIENT_RETRY_INTERVAL 秒内直接返回 None，避免每个请求都重试
+    """
+    global _client, _client_failed_at
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        if time.monotonic() - _client_failed_at < _CLIENT_RETRY_INTERVAL:
+            return None
+        try:
+            _client = genai.Client(
+                http_options=types.HttpOptions(httpx_async_client=_create_async_http_client())
+            )
+            logger.info("✅ Gemini 3 Flash Preview 客户端创建成功")
+        except Exception as e:
+            _client_failed_at = time.monotonic()
+            logger.error("❌ 初始化 Gemini 客户端失败: %s", e)
+        return _client
+
 
 def _prepare_image_part(image_data: Union[bytes, str, Path]) -> types.Part:
     """
@@ -64,7 +264,7 @@ def _prepare_image_part(image_data: Union[bytes, str, Path]) -> types.Part:
         
         raise ValueError(f"不支持的图片格式: {type(image_data)}")
     except Exception as e:
-        logger.error(f"❌ 准备图片数据失败: {e}")
+        logger.error("❌ 准备图片数据失败: %s", e)
         raise
 
 
@@ -95,18 +295,277 @@ def _detect_mime_type(image_bytes: bytes) -> str:
         return 'image/jpeg'  # 默认
 
 
-def chat(
+# 历史记录角色映射：Gemini 只接受 user / model
+_ROLE_MAP = {
+    'user': 'user',
+    'model': 'model',
+    'assistant': 'model',
+}
+
+# 安全设置（关闭所有过滤），每个请求相同，模块加载时构建一次
+_SAFETY_SETTINGS = [
+    types.SafetySetting(
+        category="HARM_CATEGORY_HATE_SPEECH",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_DANGEROUS_CONTENT",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_HARASSMENT",
+        threshold="OFF"
+    ),
+]
+
+
+def _build_contents(
+    message: str,
+    history: Optional[List] = None,
+    image_data: Optional[Union[bytes, str, List]] = None
+) -> List:
+    """
+    构建请求内容：历史记录在前、当前消息（可选参考图片）在后
+    
+    历史记录按原顺序逐条转换，相同的历史总是得到相同的请求前缀，
+    便于服务端前缀缓存复用；调用方应只在末尾追加新轮次，不要修改已有轮次
+    """
+    contents = []
+    
+    # 历史记录（前端的 assistant 角色对应 Gemini 的 model 角色）
+    if history and isinstance(history, list):
+        for item in history:
+            # 绝大多数条目格式正确，直接取值比逐项判断更快；格式不对的条目跳过
+            try:
+                role, text = item['role'], item['content']
+            except (KeyError, TypeError):
+                continue
+            if text:
+                contents.append(
+                    types.Content(role=_ROLE_MAP.get(role, 'user'), parts=[types.Part.from_text(text=text)])
+                )
+    
+    # 当前消息
+    parts = []
+    
+    # 添加参考图片（如果有）
+    if image_data:
+        try:
+            images = [image_data] if not isinstance(image_data, list) else image_data
+            for img in images:
+                if img:
+                    part = _prepare_image_part(img)
+                    parts.append(part)
+                    logger.info("✅ 已添加参考图片 (%d 张)", len(parts))
+        except Exception as e:
+            logger.warning("⚠️ 添加参考图片失败，继续使用纯文本: %s", e)
+    
+    # 添加文本消息
+    parts.append(types.Part.from_text(text=message))
+    contents.append(types.Content(role="user", parts=parts))
+    
+    return contents
+
+
+def _build_config(temperature: Optional[float] = None):
+    """构建生成参数配置"""
+    # 配置生成参数
+    config_kwargs = {
+        "temperature": temperature if temperature is not None else 1.0,
+        "top_p": 0.95,
+        "max_output_tokens": 8192,
+    }
+    
+    # 添加安全设置（关闭所有过滤）
+    config_kwargs["safety_settings"] = _SAFETY_SETTINGS
+    
+    return types.GenerateContentConfig(**config_kwargs)
+
+
+# 可重试的服务端状态码（google-genai 对 5xx 抛 ServerError，对 4xx 抛 ClientError）
+_RETRYABLE_SERVER_CODES = frozenset({500, 503})
+_RATE_LIMIT_CODE = 429
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """判断异常是否可重试：服务端 500/503、限流 429、httpx 传输层错误（连接失败、超时等）"""
+    if isinstance(error, genai_errors.ServerError):
+        return error.code in _RETRYABLE_SERVER_CODES
+    if isinstance(error, genai_errors.ClientError):
+        return error.code == _RATE_LIMIT_CODE
+    return isinstance(error, httpx.TransportError)
+
+
+def _log_retry(retry_state):
+    """重试前记录日志"""
+    logger.warning(
+        "⚠️ 请求失败 (第 %d 次)，%.1f秒后重试: %.100s",
+        retry_state.attempt_number,
+        retry_state.next_action.sleep,
+        retry_state.outcome.exception()
+    )
+
+
+# 指数退避 + 随机抖动，避免服务故障时所有请求同步重试；总耗时与次数双重上限
+_retry_policy = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential_jitter(initial=1, max=16),
+    stop=stop_after_delay(20) | stop_after_attempt(4),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+
+
+@_retry_policy
+async def _generate(client, model_name: str, contents: List, config):
+    """发送一次非流式生成请求（失败时按 _retry_policy 重试）"""
+    logger.info("📤 Gemini 3 Flash Preview 发送请求")
+    return await client.aio.models.generate_content(
+        model=model_name,
+        contents=contents,
+        config=config
+    )
+
+
+@_retry_policy
+async def _open_stream(client, model_name: str, contents: List, config):
+    """
+    建立流式请求并取回第一个片段（失败时按 _retry_policy 重试）
+    
+    只重试到拿到第一个片段为止，开始输出后不再重试，避免重复输出
+    
+    Returns:
+        (流对象, 第一个片段；空响应时为 None)
+    """
+    logger.info("📤 Gemini 3 Flash Preview 发送流式请求")
+    stream = await client.aio.models.generate_content_stream(
+        model=model_name,
+        contents=contents,
+        config=config
+    )
+    return stream, await anext(stream, None)
+
+
+# 错误信息关键字（一次扫描匹配），按匹配到的关键字映射友好提示
+_ERROR_RE = re.compile(r'(timeout|503|serviceunavailable|failed to connect)', re.IGNORECASE)
+_ERROR_MESSAGES = {
+    'timeout': _MSG_TIMEOUT,
+    '503': _MSG_UNAVAILABLE,
+    'serviceunavailable': _MSG_UNAVAILABLE,
+    'failed to connect': _MSG_CONNECT,
+}
+
+
+_SUMMARY_PREFIX = "[对话摘要]: "
+_SUMMARY_PROMPT = "请用简洁的中文总结以下对话的要点（保留用户的关键需求、事实和已得出的结论），不超过 300 字：\n\n"
+_SUMMARY_ROLE_NAMES = {'user': '用户', 'model': '助手', 'assistant': '助手'}
+
+# 摘要缓存：较早消息的哈希 -> 摘要文本，按 LRU 淘汰
+_SUMMARY_CACHE: "OrderedDict[bytes, str]" = OrderedDict()
+_SUMMARY_CACHE_MAX = 1024
+_SUMMARY_CACHE_LOCK = threading.Lock()
+
+
+async def _trim_history(client, history: Optional[List]) -> Tuple[Optional[List], Optional[str]]:
+    """
+    裁剪过长的历史记录：较早的消息替换为一条摘要，最近的消息保留原文
+    
+    摘要失败时退化为只保留最近的消息
+    
+    Returns:
+        (裁剪后的历史, 摘要消息内容；未裁剪或摘要失败时为 None)
+    """
+    if not history or len(history) <= SUMMARY_TRIGGER:
+        return history, None
+    
+    cut = (len(history) - MAX_HISTORY_TURNS) // _SUMMARY_BLOCK * _SUMMARY_BLOCK
+    older, recent = history[:cut], history[cut:]
+    
+    key = _response_cache_key(_SUMMARY_PROMPT, older)
+    with _SUMMARY_CACHE_LOCK:
+        summary = _SUMMARY_CACHE.get(key)
+        if summary is not None:
+            _SUMMARY_CACHE.move_to_end(key)
+    
+    if summary is None:
+        lines = []
+        for item in older:
+            try:
+                role, text = item['role'], item['content']
+            except (KeyError, TypeError):
+                continue
+            if text:
+                lines.append(f"{_SUMMARY_ROLE_NAMES.get(role, '用户')}: {text}")
+        try:
+            summary = await _generate_text(
+                client,
+                MODEL_NAME,
+                [types.Content(role="user", parts=[types.Part.from_text(text=_SUMMARY_PROMPT + "\n".join(lines))])],
+                types.GenerateContentConfig(
+                    temperature=0,
+                    max_output_tokens=1024,
+                    safety_settings=_SAFETY_SETTINGS
+                )
+            )
+        except Exception as e:
+            logger.warning("⚠️ 历史记录摘要失败，只保留最近 %d 条消息: %s", len(recent), e)
+            return recent, None
+        if not summary:
+            return recent, None
+        with _SUMMARY_CACHE_LOCK:
+            _SUMMARY_CACHE[key] = summary
+            if len(_SUMMARY_CACHE) > _SUMMARY_CACHE_MAX:
+                _SUMMARY_CACHE.popitem(last=False)
+        logger.info("✅ 已将 %d 条较早的历史消息压缩为摘要，长度: %d", len(older), len(summary))
+    
+    summary_content = _SUMMARY_PREFIX + summary
+    return [{'role': 'user', 'content': summary_content}] + recent, summary_content
+
+
+async def _generate_text(client, model_name: str, contents: List, config) -> str:
+    """发送生成请求并返回回复文本（空响应返回空字符串）"""
+    response = await _generate(client, model_name, contents, config)
+    return response.text if response and hasattr(response, 'text') else ""
+
+
+# 进行中的确定性请求：缓存键 -> 生成任务，相同请求并发到达时只调用一次模型
+_inflight: Dict[bytes, "asyncio.Future"] = {}
+
+
+def _error_message(error: Exception) -> str:
+    """将最终失败的异常映射为面向用户的友好提示（先按异常类型，其他异常再按错误信息关键字）"""
+    if isinstance(error, httpx.TimeoutException):
+        return _MSG_TIMEOUT
+    if isinstance(error, httpx.TransportError):
+        return _MSG_CONNECT
+    if isinstance(error, genai_errors.ClientError) and error.code == _RATE_LIMIT_CODE:
+        return _MSG_RATE_LIMIT
+    if isinstance(error, genai_errors.ServerError):
+        return _MSG_UNAVAILABLE
+    match = _ERROR_RE.search(str(error))
+    if match:
+        return _ERROR_MESSAGES[match.group(1).lower()]
+    return _MSG_GENERIC
+
+
+async def chat(
     message: str,
     history: Optional[List] = None,
     image_data: Optional[Union[bytes, str, List]] = None,
-    temperature: Optional[float] = None
+    temperature: Optional[float] = None,
+    session_id: Optional[str] = None,
+    user_id: Optional[str] = None
 ) -> str:
     """
     使用 Gemini 3 Flash Preview 模型进行文本聊天（支持图片）
     
     ⚠️ 重要：这是文本生成函数，只返回文本，不生成图片
     - 模型: gemini-3-flash-preview（多模态文本生成模型）
-    - API: client.models.generate_content()（生成内容 API）
+    - API: client.aio.models.generate_content()（异步生成内容 API，等待期间不占用线程）
     - 响应: response.text（文本响应）
     - 支持: 文本 + 可选参考图片
     
@@ -114,145 +573,163 @@ def chat(
     
     Args:
         message: 用户消息
-        history: 聊天历史记录（可选）
+        history: 聊天历史记录（可选），[{"role": "user"|"assistant"|"model", "content": 文本}, ...]，
+                 按时间顺序排列，只在末尾追加新轮次
         image_data: 参考图片数据（可选，支持字节、base64、文件路径或列表）
         temperature: 温度参数（0-2，默认 1.0）
+        session_id: 聊天会话ID（可选）。与 user_id 同时提供时由服务端保存历史：未传 history 则读取
+                    该会话最近 CHAT_HISTORY_LIMIT 条消息，成功回复后写入本轮问答
+        user_id: 已登录用户ID（可选）。历史按 (user_id, session_id) 隔离，调用方负责认证，
+                 未提供时 session_id 被忽略
     
     Returns:
         模型的文本回复，失败时返回友好的错误消息
     """
     try:
-        # 初始化客户端
-        try:
-            client = genai.Client()
-            model_name = 'gemini-3-flash-preview'
-        except Exception as e:
-            logger.error(f"❌ 初始化 Gemini 客户端失败: {e}")
-            return "抱歉，AI 服务暂时不可用，请稍后重试。"
+        history_loaded = False
+        if not (user_id and session_id):
+            session_id = None
+        elif not history:
+            history = await _load_history(user_id, session_id)
+            history_loaded = True
         
-        # 构建内容列表
-        parts = []
+        # 简单消息直接使用模板回复
+        template_text = _template_reply(message, history, image_data)
+        if template_text is not None:
+            _route_stats['template'] += 1
+            if session_id:
+                await _save_turn(user_id, session_id, message, template_text)
+            return template_text
         
-        # 添加参考图片（如果有）
-        if image_data:
-            try:
-                images = [image_data] if not isinstance(image_data, list) else image_data
-                for img in images:
-                    if img:
-                        part = _prepare_image_part(img)
-                        parts.append(part)
-                        logger.info(f"✅ 已添加参考图片 ({len(parts)} 张)")
-            except Exception as e:
-                logger.warning(f"⚠️ 添加参考图片失败，继续使用纯文本: {e}")
+        # 确定性请求先查回复缓存
+        cache_key = None
+        if temperature == 0 and not image_data:
+            cache_key = _response_cache_key(message, history)
+            cached_text = _response_cache_get(cache_key)
+            if cached_text is not None:
+                logger.info("✅ Gemini 3 Flash Preview 命中回复缓存，长度: %d", len(cached_text))
+                _route_stats['cache'] += 1
+                if session_id:
+                    await _save_turn(user_id, session_id, message, cached_text)
+                return cached_text
         
-        # 添加文本消息
-        parts.append(types.Part.from_text(text=message))
+        # 获取复用的客户端
+        client = _get_client()
+        if client is None:
+            return _MSG_UNAVAILABLE
+        model_name = MODEL_NAME
         
-        # 构建内容对象
-        contents = [types.Content(role="user", parts=parts)]
+        trimmed = await _trim_history(client, history)
+        history = trimmed[0]
+        # 只有从服务端读取的历史才把摘要写回数据库
+        if not history_loaded:
+            trimmed = None
+        contents = _build_contents(message, history, image_data)
+        generate_content_config = _build_config(temperature)
         
-        # 如果有历史记录，添加到前面
-        if history and isinstance(history, list):
-            history_contents = []
-            for item in history:
-                if isinstance(item, dict):
-                    role = item.get('role', 'user')
-                    text = item.get('content', '')
-                    if text:
-                        history_contents.append(
-                            types.Content(role=role, parts=[types.Part.from_text(text=text)])
-                        )
-            if history_contents:
-                contents = history_contents + contents
+        # 生成回复（带重试机制）；确定性请求与进行中的相同请求合并为一次调用
+        if cache_key is not None:
+            task = _inflight.get(cache_key)
+            if task is None:
+                _route_stats['model'] += 1
+                task = asyncio.ensure_future(
+                    _generate_text(client, model_name, contents, generate_content_config)
+                )
+                _inflight[cache_key] = task
+                task.add_done_callback(lambda _, key=cache_key: _inflight.pop(key, None))
+            else:
+                _route_stats['coalesced'] += 1
+                logger.info("✅ Gemini 3 Flash Preview 合并进行中的相同请求")
+            # shield：某个调用方被取消时不影响其他等待同一结果的调用方
+            result_text = await asyncio.shield(task)
+        else:
+            _route_stats['model'] += 1
+            result_text = await _generate_text(client, model_name, contents, generate_content_config)
         
-        # 配置生成参数
-        config_kwargs = {
-            "temperature": temperature or 1.0,
-            "top_p": 0.95,
-            "max_output_tokens": 8192,
-        }
+        if not result_text:
+            return _MSG_EMPTY
         
-        # 添加安全设置（关闭所有过滤）
-        config_kwargs["safety_settings"] = [
-            types.SafetySetting(
-                category="HARM_CATEGORY_HATE_SPEECH",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_HARASSMENT",
-                threshold="OFF"
-            ),
-        ]
+        logger.info("✅ Gemini 3 Flash Preview 响应成功，长度: %d", len(result_text))
+        if cache_key is not None:
+            _response_cache_put(cache_key, result_text)
+        if session_id:
+            await _save_turn(user_id, session_id, message, result_text, trimmed)
+        return result_text
         
-        generate_content_config = types.GenerateContentConfig(**config_kwargs)
+    except Exception as e:
+        logger.exception("❌ 聊天失败: %s", e)
+        return _error_message(e)
+
+
+async def chat_stream(
+    message: str,
+    history: Optional[List] = None,
+    image_data: Optional[Union[bytes, str, List]] = None,
+    temperature: Optional[float] = None,
+    session_id: Optional[str] = None,
+    user_id: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    流式版本的 chat()：边生成边产出文本片段
+    
+    参数与 chat() 相同。重试只作用于建立流（拿到第一个片段）的阶段（见 _open_stream）。
+    
+    Yields:
+        模型回复的文本片段；失败时产出一条友好的错误消息
+    """
+    try:
+        history_loaded = False
+        if not (user_id and session_id):
+            session_id = None
+        elif not history:
+            history = await _load_history(user_id, session_id)
+            history_loaded = True
         
-        # 生成回复（带重试机制）
-        max_retries = 3
-        retry_delay = 2
+        # 简单消息直接使用模板回复
+        template_text = _template_reply(message, history, image_data)
+        if template_text is not None:
+            _route_stats['template'] += 1
+            yield template_text
+            if session_id:
+                await _save_turn(user_id, session_id, message, template_text)
+            return
         
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"📤 Gemini 3 Flash Preview 发送请求 (尝试 {attempt + 1}/{max_retries})")
-                
-                response = client.models.generate_content(
-                    model=model_name,
-                    contents=contents,
-                    config=generate_content_config
-                )
-                
-                result_text = response.text if response and hasattr(response, 'text') else ""
-                if not result_text:
-                    return "抱歉，AI 返回了空响应，请重试。"
-                
-                logger.info(f"✅ Gemini 3 Flash Preview 响应成功，长度: {len(result_text)}")
-                return result_text
-                
-            except gexceptions.ServiceUnavailable as e:
-                error_msg = str(e)
-                if attempt < max_retries - 1:
-                    logger.warning(f"⚠️ 请求失败 (尝试 {attempt + 1}/{max_retries})，{retry_delay}秒后重试: {error_msg[:100]}")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                    continue
-                else:
-                    if "Timeout" in error_msg or "failed to connect" in error_msg:
-                        return "抱歉，网络连接超时，可能是网络问题或服务暂时不可用。请检查网络连接后重试。"
-                    else:
-                        return "抱歉，AI 服务暂时不可用，请稍后重试。"
-                        
-            except gexceptions.RetryError as e:
-                error_msg = str(e)
-                if attempt < max_retries - 1:
-                    logger.warning(f"⚠️ 请求失败 (尝试 {attempt + 1}/{max_retries})，{retry_delay}秒后重试: {error_msg[:100]}")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                    continue
-                else:
-                    if "Timeout" in error_msg:
-                        return "抱歉，请求超时，可能是网络问题。请检查网络连接后重试。"
-                    else:
-                        return "抱歉，AI 服务暂时不可用，请稍后重试。"
+        client = _get_client()
+        if client is None:
+            yield _MSG_UNAVAILABLE
+            return
+        model_name = MODEL_NAME
         
-        return "抱歉，AI 服务暂时不可用，请稍后重试。"
+        trimmed = await _trim_history(client, history)
+        history = trimmed[0]
+        # 只有从服务端读取的历史才把摘要写回数据库
+        if not history_loaded:
+            trimmed = None
+        contents = _build_contents(message, history, image_data)
+        generate_content_config = _build_config(temperature)
         
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"❌ 聊天失败: {e}")
-        logger.error(traceback.format_exc())
+        # 建立流式连接并取到第一个片段（带重试机制）
+        _route_stats['model'] += 1
+        stream, first_chunk = await _open_stream(client, model_name, contents, generate_content_config)
         
-        if "Timeout" in error_msg or "timeout" in error_msg.lower():
-            return "抱歉，请求超时，可能是网络问题。请检查网络连接后重试。"
-        elif "503" in error_msg or "ServiceUnavailable" in error_msg:
-            return "抱歉，AI 服务暂时不可用，请稍后重试。"
-        elif "failed to connect" in error_msg.lower():
-            return "抱歉，无法连接到 AI 服务，请检查网络连接。"
-        else:
-            return "抱歉，处理请求时出错。如果问题持续，请联系技术支持。"
+        if first_chunk is None:
+            yield _MSG_EMPTY
+            return
+        
+        texts = []
+        chunk = first_chunk
+        while chunk is not None:
+            text = chunk.text if hasattr(chunk, 'text') else None
+            if text:
+                texts.append(text)
+                yield text
+            chunk = await anext(stream, None)
+        
+        result_text = ''.join(texts)
+        logger.info("✅ Gemini 3 Flash Preview 流式响应完成，长度: %d", len(result_text))
+        if session_id and result_text:
+            await _save_turn(user_id, session_id, message, result_text, trimmed)
+        
+    except Exception as e:
+        logger.exception("❌ 流式聊天失败: %s", e)
+        yield _error_message(e)
@@ -7,23 +7,37 @@ Gemini 3 Pro Image 图片生成器 (重构版)
 import os
 import base64
 import logging
-import traceback
 import io
+import threading
 import time
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, NamedTuple
 from PIL import Image
 
 # ==================== 配置模块 ====================
+class EnvSnapshot(NamedTuple):
+    """加载 .env 后的环境变量快照（请求路径只读快照，不再逐个 os.getenv）"""
+    vertex_project: str
+    vertex_location: str
+    credentials: Optional[str]
+    api_key: Optional[str]
+    disable_proxy: bool
+    is_cloud: bool
+    socks5_proxy: str
+    proxy_url: str
+    http_timeout: str
+    socket_timeout: str
+
+
 class EnvConfig:
     """环境变量和配置管理（单一职责）"""
     
     @staticmethod
     def load_env():
-        """加载环境变量（.env 文件）"""
+        """加载环境变量（.env 文件；设置了 BANANA_ENV 时直接加载该路径，跳过 find_dotenv 的目录遍历）"""
         try:
             from dotenv import load_dotenv, find_dotenv
-            env_file = find_dotenv() or EnvConfig._find_backend_env()
+            env_file = os.environ.get('BANANA_ENV') or find_dotenv() or EnvConfig._find_backend_env()
             if env_file:
                 load_dotenv(dotenv_path=env_file, override=False)
                 return env_file
@@ -41,22 +55,41 @@ class EnvConfig:
                 return env_path
         return None
     
+    @staticmethod
+    def snapshot() -> EnvSnapshot:
+        """读取一次当前环境变量并生成快照"""
+        env = os.environ
+        return EnvSnapshot(
+            vertex_project=(env.get("VERTEX_AI_PROJECT") or env.get("GOOGLE_CLOUD_PROJECT") or "").strip(),
+            vertex_location=(env.get("VERTEX_AI_LOCATION", "global") or "").strip(),
+            credentials=env.get("GOOGLE_APPLICATION_CREDENTIALS"),
+            api_key=env.get("GOOGLE_CLOUD_API_KEY"),
+            disable_proxy=env.get('DISABLE_PROXY', '').lower() == 'true',
+            is_cloud=bool(env.get('K_SERVICE') or env.get('GAE_ENV')),
+            # 只有 USE_SOCKS5_PROXY=true 时才使用 SOCKS5 地址
+            socks5_proxy=(env.get('SOCKS5_PROXY', '').strip()
+                          if env.get('USE_SOCKS5_PROXY', '').lower() == 'true' else ''),
+            proxy_url=(env.get('HTTP_PROXY') or env.get('HTTPS_PROXY') or
+                       f"http://{env.get('PROXY_HOST', '127.0.0.1')}:{env.get('PROXY_PORT', '29290')}"),
+            # 超时只保存原始字符串，创建 Client 时再解析（非法值在 create 中报错而不是导入失败）
+            http_timeout=env.get('HTTP_TIMEOUT', '1200000'),
+            socket_timeout=env.get('SOCKET_TIMEOUT', '1200'),
+        )
+    
     @staticmethod
     def should_use_proxy() -> bool:
         """判断是否使用代理"""
         # 优先级：DISABLE_PROXY > Cloud环境 > SOCKS5 > HTTP
-        if os.getenv('DISABLE_PROXY', '').lower() == 'true':
+        if _ENV.disable_proxy:
             ProxyConfig.clear_proxy_env()
             return False
         
-        if os.getenv('K_SERVICE') or os.getenv('GAE_ENV'):
+        if _ENV.is_cloud:
             return False
         
         # SOCKS5 优先
-        if os.getenv('USE_SOCKS5_PROXY', '').lower() == 'true':
-            socks5_proxy = os.getenv('SOCKS5_PROXY', '').strip()
-            if socks5_proxy:
-                return ProxyConfig.setup_socks5(socks5_proxy)
+        if _ENV.socks5_proxy:
+            return ProxyConfig.setup_socks5(_ENV.socks5_proxy)
         
         # HTTP 代理
         return ProxyConfig.setup_http()
@@ -87,20 +120,32 @@ class ProxyConfig:
     @staticmethod
     def setup_http() -> bool:
         """配置 HTTP 代理"""
-        proxy_url = (os.getenv('HTTP_PROXY') or os.getenv('HTTPS_PROXY') or 
-                     f"http://{os.getenv('PROXY_HOST', '127.0.0.1')}:{os.getenv('PROXY_PORT', '29290')}")
         for key in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy']:
-            os.environ[key] = proxy_url
+            os.environ[key] = _ENV.proxy_url
         return True
 
 
 # ==================== 初始化 ====================
 logger = logging.getLogger("果捷后端")
-env_file = EnvConfig.load_env()
-if env_file:
-    logger.info(f"✅ [gemini_3_pro_image] 已加载环境: {env_file}")
+
+# .env 每个进程只加载一次；与 gemini_2_5_flash_image 共用环境变量标记，先导入的模块加载后其余模块直接跳过
+_ENV_LOADED_FLAG = '_BANANA_ENV_LOADED'
+if not os.environ.get(_ENV_LOADED_FLAG):
+    env_file = EnvConfig.load_env()
+    os.environ[_ENV_LOADED_FLAG] = '1'
+    if env_file:
+        logger.info("✅ [gemini_3_pro_image] 已加载环境: %s", env_file)
+_ENV = EnvConfig.snapshot()
 EnvConfig.should_use_proxy()
 
+
+def _refresh_env():
+    """重新读取环境变量快照（测试或运行期修改环境变量后调用）"""
+    global _ENV
+    _ENV = EnvConfig.snapshot()
+    return _ENV
+
+
 # 导入 google.genai
 try:
     from google import genai as genai_new
@@ -113,19 +158,35 @@ except ImportError:
 
 
 # ==================== 客户端管理 ====================
+# 进程内复用的 Client（复用底层 httpx 连接池，避免每个请求重新建立 TLS 连接）
+_client = None
+_client_lock = threading.Lock()
+
+
 class GeminiClient:
     """Gemini Client 管理（单一职责）"""
     
+    @staticmethod
+    def get():
+        """获取复用的 Gemini Client（双重检查加锁，只创建一次；创建失败返回 None，下次调用重试）"""
+        global _client
+        if _client is not None:
+            return _client
+        with _client_lock:
+            if _client is None:
+                _client = GeminiClient.create()
+            return _client
+    
     @staticmethod
     def create():
         """创建 Gemini Client"""
         if not GEMINI_NEW_AVAILABLE:
             return None
         
-        project_id = (os.getenv("VERTEX_AI_PROJECT") or os.getenv("GOOGLE_CLOUD_PROJECT") or "").strip()
-        location = (os.getenv("VERTEX_AI_LOCATION", "global") or "").strip()
-        credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        api_key = os.getenv("GOOGLE_CLOUD_API_KEY")
+        project_id = _ENV.vertex_project
+        location = _ENV.vertex_location
+        credentials = _ENV.credentials
+        api_key = _ENV.api_key
         
         if not project_id:
             logger.error("❌ VERTEX_AI_PROJECT 未设置")
@@ -139,7 +200,7 @@ class GeminiClient:
             # 配置 httpx 客户端
             http_client = GeminiClient._create_http_client()
             http_options = types.HttpOptions(
-                timeout=int(os.getenv('HTTP_TIMEOUT', '1200000')),
+                timeout=int(_ENV.http_timeout),
                 httpx_client=http_client
             )
             
@@ -161,7 +222,8 @@ class GeminiClient:
         import httpx
         from httpx import Limits
         
-        socket_timeout = int(os.getenv('SOCKET_TIMEOUT', '1200'))
+        socket_timeout = int(_ENV.socket_timeout)
+        # 代理地址由 should_use_proxy 写入环境变量，这里读取写入后的结果
         proxy_url = os.getenv('ALL_PROXY') or os.getenv('HTTPS_PROXY') or os.getenv('HTTP_PROXY')
         
         limits = Limits(
@@ -189,91 +251,103 @@ class GeminiClient:
         return httpx.Client(limits=limits, timeout=timeout)
 
 
+def _reset_client():
+    """丢弃已缓存的 Client（测试或运行期轮换凭据后调用），下次请求按当前环境变量重新创建"""
+    global _client
+    with _client_lock:
+        _client = None
+
+
 # ==================== 图片处理工具 ====================
+_BASE64_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n\r")
+_IMAGE_MAGIC = (b"\xFF\xD8\xFF", b"\x89PNG", b"GIF87a", b"GIF89a", b"RIFF")  # RIFF: WebP
+
+
+def _looks_like_base64_text(text: str) -> bool:
+    return bool(text) and len(text) % 4 == 0 and _BASE64_CHARS.issuperset(text)
+
+
+def _decode_base64_to_bytes(text: str) -> Optional[bytes]:
+    try:
+        return base64.b64decode(text, validate=True)
+    except Exception:
+        try:
+            return base64.b64decode(text)
+        except Exception:
+            return None
+
+
+def _iter_parts(response):
+    """依次产出所有 candidate 的 content.parts（只遍历一次，缺失的层级直接跳过）"""
+    for candidate in getattr(response, 'candidates', None) or ():
+        yield from getattr(getattr(candidate, 'content', None), 'parts', None) or ()
+
+
+def _decode_inline_data(data) -> Tuple[Optional[bytes], bool]:
+    """
+    将 inline_data.data 统一为原始图片 bytes
+    
+    Returns:
+        (图片 bytes, 是否由 base64 解码得到)；字符串且无法解码时返回 (None, False)
+    """
+    if isinstance(data, bytes):
+        # 可能是 base64 文本 bytes；原始 PNG/JPEG 首字节不是 ASCII，decode 会立即失败
+        try:
+            text = data.decode('ascii')
+        except UnicodeDecodeError:
+            return data, False
+    elif isinstance(data, str):
+        text = data
+    else:
+        return None, False
+    
+    if _looks_like_base64_text(text):
+        decoded = _decode_base64_to_bytes(text)
+        if decoded and decoded.startswith(_IMAGE_MAGIC):
+            return decoded, True
+    return (data, False) if isinstance(data, bytes) else (None, False)
+
+
 class ImageProcessor:
     """图片处理工具（单一职责）"""
     
     @staticmethod
     def extract_from_response(response, function_name: str = "生图") -> Optional[Tuple[bytes, str]]:
-        """从响应中提取图片数据"""
+        """从响应中提取图片数据（单次遍历所有 parts，返回第一张可用图片）"""
         try:
-            if not hasattr(response, 'candidates') or not response.candidates:
-                logger.warning(f"⚠️ [{function_name}] response.candidates 为空，可能被安全过滤")
+            if not getattr(response, 'candidates', None):
+                logger.warning("⚠️ [%s] response.candidates 为空，可能被安全过滤", function_name)
                 return None
             
-            candidate = response.candidates[0]
-            if not hasattr(candidate, 'content') or not hasattr(candidate.content, 'parts'):
-                logger.warning(f"⚠️ [{function_name}] candidate.content.parts 为空，无法提取图片")
-                return None
+            for part in _iter_parts(response):
+                inline_data = getattr(part, 'inline_data', None)
+                if not inline_data:
+                    continue
+                data = inline_data.data
+                mime_type = inline_data.mime_type
+                image_bytes, was_base64 = _decode_inline_data(data)
+                if image_bytes is None:
+                    logger.warning("⚠️ [%s] inline_data 为字符串但无法解码，长度=%d", function_name, len(data))
+                    continue
+                if was_base64:
+                    logger.warning("⚠️ [%s] inline_data 为 base64(%s)，已解码为原始图片 bytes",
+                                   function_name, type(data).__name__)
+                else:
+                    logger.info("✅ [%s] inline_data bytes: %d bytes, mime=%s", function_name, len(image_bytes), mime_type)
+                return image_bytes, mime_type
             
-            def _looks_like_base64_text(text: str) -> bool:
-                if not text or len(text) % 4 != 0:
-                    return False
-                base64_chars = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n\r")
-                return all(ch in base64_chars for ch in text)
-
-            def _decode_base64_to_bytes(text: str) -> Optional[bytes]:
-                try:
-                    decoded = base64.b64decode(text, validate=True)
-                    return decoded
-                except Exception:
-                    try:
-                        return base64.b64decode(text)
-                    except Exception:
-                        return None
-
-            def _is_image_magic(raw: bytes) -> bool:
-                return (
-                    raw.startswith(b"\xFF\xD8\xFF") or
-                    raw.startswith(b"\x89PNG") or
-                    raw.startswith(b"GIF87a") or
-                    raw.startswith(b"GIF89a") or
-                    raw.startswith(b"RIFF")  # WebP
-                )
-
-            # 查找图片 part
-            found_parts = []
-            for idx, part in enumerate(candidate.content.parts):
-                part_type = "unknown"
-                if hasattr(part, 'inline_data'):
-                    part_type = "inline_data"
-                elif hasattr(part, 'text'):
-                    part_type = "text"
-                found_parts.append(f"part[{idx}]={part_type}")
-
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    mime_type = part.inline_data.mime_type
-                    data = part.inline_data.data
-
-                    if isinstance(data, bytes):
-                        # 可能是 base64 文本 bytes
-                        try:
-                            text = data.decode('ascii')
-                            if _looks_like_base64_text(text):
-                                decoded = _decode_base64_to_bytes(text)
-                                if decoded and _is_image_magic(decoded):
-                                    logger.warning(f"⚠️ [{function_name}] inline_data 为 base64(bytes)，已解码为原始图片 bytes")
-                                    return decoded, mime_type
-                        except Exception:
-                            pass
-
-                        logger.info(f"✅ [{function_name}] inline_data bytes: {len(data)} bytes, mime={mime_type}")
-                        return data, mime_type
-
-                    elif isinstance(data, str):
-                        # 允许 base64 字符串，解码为原始 bytes 再返回
-                        if _looks_like_base64_text(data):
-                            decoded = _decode_base64_to_bytes(data)
-                            if decoded and _is_image_magic(decoded):
-                                logger.warning(f"⚠️ [{function_name}] inline_data 为 base64(str)，已解码为原始图片 bytes")
-                                return decoded, mime_type
-                        logger.warning(f"⚠️ [{function_name}] inline_data 为字符串但无法解码，长度={len(data)}")
-                        return None
-
-            logger.warning(f"⚠️ [{function_name}] 未找到 inline_data 图片，parts={', '.join(found_parts)}")
+            # 只有提取失败时才汇总 parts 类型，成功路径不构造诊断字符串
+            found_parts = [
+                f"part[{idx}]={'inline_data' if hasattr(part, 'inline_data') else 'text' if hasattr(part, 'text') else 'unknown'}"
+                for idx, part in enumerate(_iter_parts(response))
+            ]
+            if not found_parts:
+                logger.warning("⚠️ [%s] candidate.content.parts 为空，无法提取图片", function_name)
+            else:
+                logger.warning("⚠️ [%s] 未找到 inline_data 图片，parts=%s", function_name, ', '.join(found_parts))
             return None
         except Exception as e:
-            logger.error(f"❌ [{function_name}] 提取图片失败: {e}")
+            logger.error("❌ [%s] 提取图片失败: %s", function_name, e)
             return None
     
     @staticmethod
@@ -404,7 +478,7 @@ def generate_with_gemini_image3(
         return {"error": True, "error_type": "ModuleNotAvailable", 
                 "error_message": "google.genai 模块不可用"}
     
-    client = GeminiClient.create()
+    client = GeminiClient.get()
     if not client:
         return {"error": True, "error_type": "ClientCreationFailed",
                 "error_message": "无法创建 Client"}
@@ -534,9 +608,8 @@ def generate_with_gemini_image3(
     except Exception as e:
         error_type = type(e).__name__
         error_message = str(e)
-        logger.error(f"❌ [Gemini 3 Pro] 生成失败: {error_message}")
-        logger.error(f"异常类型: {error_type}")
-        logger.error(f"完整堆栈:\n{traceback.format_exc()}")
+        # exc_info 交给日志处理器在真正输出时再格式化堆栈
+        logger.error("❌ [Gemini 3 Pro] 生成失败 (%s): %s", error_type, error_message, exc_info=True)
         
         # ⚠️ 重要：不要在返回的字典中包含 traceback，因为它可能包含对象引用导致序列化失败
         return {
@@ -6,8 +6,8 @@ Imagen 3.0 Capability 图片生成器
 """
 import os
 import base64
+import binascii
 import logging
-import traceback
 import io
 from typing import Optional, List
 from PIL import Image
@@ -273,7 +273,8 @@ def generate_with_imagen_3_capability(prompt: str, reference_images: Optional[Li
         logger.info(f"   图片大小: {len(image_bytes)} bytes ({len(image_bytes) / 1024:.2f} KB)")
         
         # 转换为 base64 data URL
-        image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+        # base64 结果是纯 ASCII，直接用 binascii 编码并按 ascii 解码
+        image_b64 = binascii.b2a_base64(image_bytes, newline=False).decode('ascii')
         data_url_prefix = f"data:{mime_type};base64,"
         return f"{data_url_prefix}{image_b64}"
             
@@ -290,5 +291,5 @@ def generate_with_imagen_3_capability(prompt: str, reference_images: Optional[Li
             logger.error("   3. 账户没有访问权限")
             logger.error("💡 建议：如果文生图失败，可能需要使用 imagen-3.0-generate-001 或其他支持文生图的模型")
         
-        logger.error(f"📋 完整错误堆栈:\n{traceback.format_exc()}")
+        logger.error("📋 完整错误堆栈", exc_info=True)
         return None
@@ -4,8 +4,8 @@ Imagen 4.0 图片生成器
 使用 Imagen 4.0 Ultra (imagen-4.0-ultra-generate-001) 模型进行文生图
 """
 import base64
+import binascii
 import logging
-import traceback
 from typing import Optional
 from google.genai import types
 
@@ -137,20 +137,23 @@ def generate_with_imagen(client, prompt: str, aspect_ratio: Optional[str] = None
             # 🔍 关键调试：打印原始 image_bytes 的前50个字节（用于对比）
             # 如果是 JPEG 图片，前几个字节应该是: b'\xff\xd8\xff\xe0' (JPEG 文件头)
             # Base64 编码后应该是: /9j/4AAQ... (Lzlq 是错误的)
+            image_size_bytes = len(image_bytes)
             logger.info(f"🔍 [调试] 原始 image_bytes 类型: {type(image_bytes)}")
-            logger.info(f"🔍 [调试] 原始 image_bytes 长度: {len(image_bytes)} bytes")
+            logger.info(f"🔍 [调试] 原始 image_bytes 长度: {image_size_bytes} bytes")
             if isinstance(image_bytes, bytes):
+                # 前50字节只切片一次，三种预览共用
+                head = image_bytes[:50]
                 # 打印原始字节的前50个（十六进制）
-                hex_preview = image_bytes[:50].hex()
+                hex_preview = head.hex()
                 logger.info(f"🔍 [调试] 原始 image_bytes 前50字节(hex): {hex_preview}")
                 # 打印原始字节的前50个（如果可打印）
                 try:
-                    ascii_preview = image_bytes[:50].decode('latin-1', errors='replace')
+                    ascii_preview = head.decode('latin-1', errors='replace')
                     logger.info(f"🔍 [调试] 原始 image_bytes 前50字节(ascii): {repr(ascii_preview)}")
                 except:
                     pass
                 # 直接对原始字节进行 base64 编码，查看前50个字符
-                raw_b64_preview = base64.b64encode(image_bytes[:50]).decode('utf-8')
+                raw_b64_preview = base64.b64encode(head).decode('utf-8')
                 logger.info(f"🔍 [调试] 原始 image_bytes 前50字节的 base64: {raw_b64_preview}")
             
             # 4.3 提取增强后的提示词（如果模型支持提示增强）
@@ -173,7 +176,8 @@ def generate_with_imagen(client, prompt: str, aspect_ratio: Optional[str] = None
                 image_b64 = image_bytes
             else:
                 # 只有是 bytes 类型时才编码
-                image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+                # base64 结果是纯 ASCII，直接用 binascii 编码并按 ascii 解码
+                image_b64 = binascii.b2a_base64(image_bytes, newline=False).decode('ascii')
             
             # 🔍 关键调试：此时 image_b64 应该是正常的 /9j/ 开头
             logger.info(f"🔍 [调试] 最终 base64 字符串前50字符: {image_b64[:50]}")
@@ -196,7 +200,7 @@ def generate_with_imagen(client, prompt: str, aspect_ratio: Optional[str] = None
                     raise Exception(f"检测到二次编码但无法修复: {decode_error}")
             
             logger.info(f"✅ Imagen 4.0 生图成功")
-            logger.info(f"   图片大小: {len(image_bytes)} bytes ({len(image_bytes) / 1024:.2f} KB)")
+            logger.info(f"   图片大小: {image_size_bytes} bytes ({image_size_bytes / 1024:.2f} KB)")
             logger.info(f"   MIME 类型: {mime_type}")
             
             # 根据实际的 MIME 类型返回正确的 data URL
@@ -227,5 +231,4 @@ def generate_with_imagen(client, prompt: str, aspect_ratio: Optional[str] = None
         elif 'authentication' in error_lower or 'unauthorized' in error_lower:
             logger.error("💡 提示：API 密钥无效或认证失败")
         
-        logger.error(f"📋 完整错误堆栈:\n{traceback.format_exc()}")
         return None
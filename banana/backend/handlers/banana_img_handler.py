@@ -4,12 +4,15 @@ Banana Image 请求处理器 - 统一图像生成接口
 """
 import io
 import time
+import logging
 from typing import Optional, List, Tuple, Dict, Any
 from fastapi import Request, UploadFile
 from PIL import Image
 
 from log_utils import log_info, log_error, log_warning, log_success
 
+logger = logging.getLogger("果捷后端")
+
 
 class BananaImageRequest:
     """请求数据模型"""
@@ -79,8 +82,7 @@ class FormDataParser:
         except Exception as e:
             log_error("FormData解析失败", f"未知错误: {str(e)} (类型: {type(e).__name__})", 
                      {"请求": req_data.request_id})
-            import traceback
-            log_error("完整堆栈", traceback.format_exc(), {"请求": req_data.request_id})
+            logger.error("📋 [完整堆栈] 请求: %s", req_data.request_id, exc_info=True)
             return False
     
     @staticmethod
@@ -152,8 +154,7 @@ class JSONParser:
         except Exception as e:
             log_error("JSON解析失败", f"未知错误: {str(e)} (类型: {type(e).__name__})", 
                      {"请求": req_data.request_id})
-            import traceback
-            log_error("完整堆栈", traceback.format_exc(), {"请求": req_data.request_id})
+            logger.error("📋 [完整堆栈] 请求: %s", req_data.request_id, exc_info=True)
             return False
 
 
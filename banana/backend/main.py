@@ -142,16 +142,15 @@ origins = [
     "https://gj.emaos.top/",
 ]
 
-# 从环境变量读取生产环境的前端地址（多个地址用逗号分隔）
-frontend_origins_env = os.getenv("FRONTEND_ORIGINS", "")
-if frontend_origins_env:
-    env_origins = [origin.strip() for origin in frontend_origins_env.split(",") if origin.strip()]
-    for origin in env_origins:
-        normalized = origin.rstrip("/")
-        if normalized and normalized not in origins:
-            origins.append(normalized)
-        if origin.endswith("/") and origin not in origins:
-            origins.append(origin)
+# 从环境变量读取生产环境的前端地址（多个地址用逗号分隔，由 config 统一解析一次）
+from config import get_frontend_origins
+
+for origin in get_frontend_origins():
+    normalized = origin.rstrip("/")
+    if normalized and normalized not in origins:
+        origins.append(normalized)
+    if origin.endswith("/") and origin not in origins:
+        origins.append(origin)
 
 print(f"🌐 CORS 允许的源: {origins}")
 
@@ -195,6 +194,12 @@ try:
     except Exception as e:
         logger.error(f"❌ 数据库初始化失败: {e}")
         logger.warning("⚠️  用户认证功能可能不可用")
+    
+    # 后台定期清理过期会话；应用关闭时先停止清理线程，再释放各线程缓存的数据库连接
+    from database import start_session_cleanup, stop_session_cleanup, close_db
+    app.add_event_handler("startup", start_session_cleanup)
+    app.add_event_handler("shutdown", stop_session_cleanup)
+    app.add_event_handler("shutdown", close_db)
 except ImportError as e:
     logger.error(f"❌ 无法导入数据库模块: {e}")
     logger.warning("⚠️  用户认证功能不可用")
@@ -3,15 +3,16 @@
 用户认证 API 路由
 """
 
+import time
 import logging
 import traceback
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 
 from database import (
-    create_user, verify_user_login, get_user_by_id,
+    create_user, verify_user_login_async, get_user_by_id,
     create_session, delete_session, verify_password
 )
 from config import MANAGER_ACCOUNT, MANAGER_PASSWORD
@@ -26,6 +27,9 @@ router = APIRouter(prefix="/api/auth", tags=["认证"])
 # 这个字典用于内存缓存和向后兼容，但数据会同时保存到数据库
 user_sessions = {}
 
+# 会话有效期（秒）
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
 def generate_session_token() -> str:
     """生成会话令牌"""
     import secrets
@@ -147,7 +151,7 @@ async def register(request: RegisterRequest):
         session_token = generate_session_token()
         
         # 保存到数据库（24小时过期）
-        expires_at = (datetime.now() + timedelta(days=1)).isoformat()
+        expires_at = int(time.time()) + SESSION_TTL_SECONDS
         create_session(session_token, user['id'], expires_at)
         
         # 同时保存到内存（向后兼容）
@@ -203,7 +207,7 @@ async def login(request: LoginRequest):
                 session_token = generate_session_token()
                 
                 # 保存到数据库（24小时过期）
-                expires_at = (datetime.now() + timedelta(days=1)).isoformat()
+                expires_at = int(time.time()) + SESSION_TTL_SECONDS
                 create_session(session_token, manager_user['id'], expires_at)
                 
                 # 同时保存到内存（向后兼容）
@@ -222,7 +226,7 @@ async def login(request: LoginRequest):
         # 验证用户登录
         log_info("登录", "验证用户登录", {"账号": account, "密码长度": len(password)})
         
-        user = verify_user_login(account, password)
+        user = await verify_user_login_async(account, password)
         
         if not user:
             log_warning("登录", "验证失败", {"账号": account, "原因": "账号或密码错误"})
@@ -232,7 +236,7 @@ async def login(request: LoginRequest):
         session_token = generate_session_token()
         
         # 保存到数据库（24小时过期）
-        expires_at = (datetime.now() + timedelta(days=1)).isoformat()
+        expires_at = int(time.time()) + SESSION_TTL_SECONDS
         create_session(session_token, user['id'], expires_at)
         
         # 同时保存到内存（向后兼容）
@@ -4,17 +4,27 @@
 支持多模态输入：文本 + 可选参考图片
 """
 
+import json
 import logging
 import traceback
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 from log_utils import log_info, log_error, log_success
 
-from generators.gemini_3_flash_preview import chat
+from generators.gemini_3_flash_preview import chat, chat_stream
+from routes.auth import get_user_from_session
 
 logger = logging.getLogger("聊天API")
 
+# orjson 解析更快，未安装时使用标准库 json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 router = APIRouter(prefix="/api", tags=["聊天"])
 
 
@@ -25,12 +35,29 @@ class ChatRequest(BaseModel):
     mode: str = "chat"
     history: list = []
     temperature: Optional[float] = None
+    session_id: Optional[str] = None
+
+
+def _history_owner(req: Request, session_id: Optional[str]) -> Optional[str]:
+    """
+    获取服务端聊天历史的归属用户ID
+    
+    未传 session_id 时不使用服务端历史，返回 None；传了 session_id 则必须登录，
+    历史按 (用户ID, session_id) 隔离，无法读取或追加其他用户的会话
+    """
+    if not session_id:
+        return None
+    session_token = req.headers.get("Authorization", "").replace("Bearer ", "")
+    user = get_user_from_session(session_token) if session_token else None
+    if not user:
+        raise HTTPException(status_code=401, detail="使用 session_id 保存聊天历史需要登录")
+    return user['id']
 
 
 # ==================== API 端点 ====================
 
 @router.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, req: Request):
     """
     聊天接口（纯文本）
     
@@ -39,6 +66,7 @@ async def chat_endpoint(request: ChatRequest):
     - mode: 聊天模式（默认: "chat"）
     - history: 历史对话记录（可选）
     - temperature: 温度参数 0-2（可选，默认 1.0）
+    - session_id: 聊天会话ID（可选，需登录；提供时由服务端保存历史，可不再传 history）
     """
     try:
         message = request.message
@@ -48,12 +76,15 @@ async def chat_endpoint(request: ChatRequest):
         
         if not message:
             raise HTTPException(status_code=400, detail="消息内容不能为空")
+        user_id = _history_owner(req, request.session_id)
         
         # 调用生成器模块的聊天函数
-        response_text = chat(
+        response_text = await chat(
             message=message,
             history=history,
-            temperature=temperature
+            temperature=temperature,
+            session_id=request.session_id,
+            user_id=user_id
         )
         
         log_success("聊天", "处理聊天请求成功", {"消息": message[:50] + "..."})
@@ -75,6 +106,34 @@ async def chat_endpoint(request: ChatRequest):
         }
 
 
+@router.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, req: Request):
+    """
+    聊天接口（纯文本，流式输出）
+    
+    参数同 /api/chat，响应为 text/plain 分块流，模型每生成一段文本即推送给前端，
+    首字延迟取决于首个片段而非完整回复
+    """
+    if not request.message:
+        raise HTTPException(status_code=400, detail="消息内容不能为空")
+    user_id = _history_owner(req, request.session_id)
+    
+    log_info("聊天", "开始流式聊天请求", {"消息": request.message[:50] + "..."})
+    
+    # 异步生成器直接在事件循环中迭代，等待模型输出期间不占用线程
+    return StreamingResponse(
+        chat_stream(
+            message=request.message,
+            history=request.history or [],
+            temperature=request.temperature,
+            session_id=request.session_id,
+            user_id=user_id
+        ),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/chat-with-images")
 async def chat_with_images_endpoint(request: Request):
     """
@@ -85,6 +144,7 @@ async def chat_with_images_endpoint(request: Request):
     - mode: 聊天模式（默认: "chat"）
     - history: 历史对话记录 JSON 字符串（可选）
     - temperature: 温度参数 0-2（可选，默认 1.0）
+    - session_id: 聊天会话ID（可选，需登录；提供时由服务端保存历史）
     - reference_images: 参考图片文件列表（可选，多个）
     """
     try:
@@ -98,13 +158,14 @@ async def chat_with_images_endpoint(request: Request):
         mode = form_data.get('mode', 'chat')
         history_str = form_data.get('history')
         temperature = form_data.get('temperature')
+        session_id = form_data.get('session_id') or None
+        user_id = _history_owner(request, session_id)
         
         # 解析历史记录
         history_list = []
         if history_str:
-            import json
             try:
-                history_list = json.loads(history_str)
+                history_list = _json_loads(history_str)
             except:
                 logger.warning(f"⚠️ 历史记录解析失败，使用空列表")
         
@@ -133,11 +194,13 @@ async def chat_with_images_endpoint(request: Request):
                         logger.warning(f"⚠️ 读取参考图片失败: {file.filename}, 错误: {e}")
         
         # 调用生成器模块的聊天函数
-        response_text = chat(
+        response_text = await chat(
             message=message,
             history=history_list,
             image_data=image_data_list if image_data_list else None,
-            temperature=temperature
+            temperature=temperature,
+            session_id=session_id,
+            user_id=user_id
         )
         
         log_success(